@@ -1,45 +1,99 @@
+import threading
 import astra
 import numpy as np
 
-def iradon_astra(sinogram, theta, output_size):
+# Cache of the reconstructors, keyed by (angles, detector width, output size, gpu)
+_astra_cache = {}
+_astra_lock = threading.Lock()
+
+class AstraReconstructor(object):
+
+    ''' FBP reconstruction of successive sinograms with the same geometry, using the 
+    astra toolbox. The geometries, projector, data objects and algorithm are created
+    once and reused for each slice. gpu=True runs FBP_CUDA, gpu=False the CPU FBP
+    with a linear projector (no NVIDIA hardware needed). The data objects are shared,
+    so the reconstructions of different threads run one at a time'''
+
+    def __init__(self, theta, npix, output_size, gpu=True):
+
+        # Convert angles in rad
+        theta = 2*np.pi*np.asarray(theta)/360.
+
+        # Create geometries and initialise projectors
+        self.vol_geom = astra.create_vol_geom(output_size, output_size)
+        self.proj_geom = astra.create_proj_geom('parallel', 1.0, npix, theta)
+        self.proj_id = astra.create_projector('cuda' if gpu is True else 'linear', self.proj_geom, self.vol_geom)
+        self.sinogram_id = astra.data2d.create('-sino', self.proj_geom, 0)
+
+        # Create a data object for the reconstruction
+        self.rec_id = astra.data2d.create('-vol', self.vol_geom, 0)
+
+        # Create configuration 
+        cfg = astra.astra_dict('FBP_CUDA' if gpu is True else 'FBP')
+        cfg['ReconstructionDataId'] = self.rec_id
+        cfg['ProjectionDataId'] = self.sinogram_id
+        cfg['ProjectorId'] = self.proj_id
+
+        # Create the algorithm object from the configuration structure
+        self.alg_id = astra.algorithm.create(cfg)
+        self.lock = threading.Lock()
+
+    def reconstruct(self, sinogram):
+
+        ''' Reconstruction of a sinogram (pixels, angles)'''
+
+        with self.lock:
+            # The proj_geom of astra needs a sino in the shape (angles, pixels)
+            astra.data2d.store(self.sinogram_id, np.transpose(sinogram))
+            astra.data2d.store(self.rec_id, 0)
+
+            astra.algorithm.run(self.alg_id)
+
+            # Get the result
+            return astra.data2d.get(self.rec_id)
+
+    def close(self):
+
+        ''' Release the astra objects. Note that GPU memory is tied up in the 
+        algorithm object, and main RAM in the data objects'''
+
+        with self.lock:
+            if self.alg_id is not None:
+                astra.algorithm.delete(self.alg_id)
+                astra.data2d.delete(self.rec_id)
+                astra.data2d.delete(self.sinogram_id)
+                astra.projector.delete(self.proj_id)
+                self.alg_id = None
+
+def astra_reconstructor(theta, npix, output_size, gpu=True):
+
+    ''' AstraReconstructor of a geometry, created once and cached'''
+
+    key = (tuple(np.round(np.asarray(theta, dtype='float64'), 9)), int(npix), int(output_size), bool(gpu))
+    with _astra_lock:
+        try:
+            return _astra_cache[key]
+        except KeyError:
+            pass
+
+        reconstructor = AstraReconstructor(theta, npix, output_size, gpu)
+        _astra_cache[key] = reconstructor
+
+    return reconstructor
+
+def clear_astra_cache():
+
+    ''' Release the cached reconstructors (e.g. when a new scan is loaded)'''
+
+    with _astra_lock:
+        for reconstructor in _astra_cache.values():
+            reconstructor.close()
+        _astra_cache.clear()
+
+def iradon_astra(sinogram, theta, output_size, gpu=True):
 
     ''' Implementation of the FBP algorithm using GPU accelerated FBP_CUDA
-    from the astra toolbox.
+    (or the CPU FBP with gpu=False) from the astra toolbox.
     The output is fully compatible with skimage.transform.iradon'''
-    
-    # The proj_geom of astra needs a sino in the shape (angles, pixels)
-    sino = np.transpose(sinogram)
-    
-    # Convert angles in rad
-    theta = 2*np.pi*theta/360.
-
-    # Create geometries and initialise projectors
-    vol_geom = astra.create_vol_geom(output_size, output_size)
-    proj_geom = astra.create_proj_geom('parallel', 1.0, sino.shape[1], theta)
-    proj_id = astra.create_projector('cuda',proj_geom,vol_geom)
-    sinogram_id = astra.data2d.create('-sino', proj_geom, sino)
-
-    # Create a data object for the reconstruction
-    rec_id = astra.data2d.create('-vol', vol_geom)
-
-    # Create configuration 
-    cfg = astra.astra_dict('FBP_CUDA')
-    cfg['ReconstructionDataId'] = rec_id
-    cfg['ProjectionDataId'] = sinogram_id
-
-
-    # Create and run the algorithm object from the configuration structure
-    alg_id = astra.algorithm.create(cfg)
-    astra.algorithm.run(alg_id)
-
-    # Get the result
-    rec = astra.data2d.get(rec_id)
-
-    # Clean up. Note that GPU memory is tied up in the algorithm object,
-    # and main RAM in the data objects.
-    astra.algorithm.delete(alg_id)
-    astra.data2d.delete(rec_id)
-    astra.data2d.delete(sinogram_id)
-    astra.projector.delete(proj_id)
-
-    return rec
+
+    return astra_reconstructor(theta, sinogram.shape[0], output_size, gpu).reconstruct(sinogram)
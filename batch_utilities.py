@@ -0,0 +1,488 @@
+''' This file contains the functions used to process the slices of a scan
+    in parallel on several cores, as a pipeline of concurrent stages'''
+
+import os
+import json
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Shared memory blocks are available from Python 3.8. Without them the slices
+# are processed in the calling process
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY = True
+except ImportError:
+    SHARED_MEMORY = False
+
+from common_utilities import remove_blob_sino_wavelet
+from deconvolution_CPUutilities import runDeconvolutionCPUBatch
+from io_utilities import read_sinogram_slab
+from fbp_CPUutilities import iradon_cpu
+
+
+def process_slab(sinograms, pixel_size=None, noise_level=0.05, transfer=None, sigma=None, fft_workers=-1):
+
+    ''' Per-slice processing of a block of sinograms (slices, pixels, angles), done in 
+    place: deconvolution when pixel_size is given, then blob removal when sigma is 
+    given. fft_workers is the number of threads used by the FFTs of the deconvolution'''
+
+    if pixel_size is not None:
+        sinograms[...] = runDeconvolutionCPUBatch(sinograms, pixel_size, noise_level=noise_level, \
+                                                  transfer=transfer, workers=fft_workers)
+
+    if sigma is not None:
+        for k in range(len(sinograms)):
+            sinograms[k] = remove_blob_sino_wavelet(sinograms[k], sigma=sigma)
+
+    return sinograms
+
+def reconstruct_stored(storename, shape, k, theta, output_size, shift=0.0):
+
+    ''' FBP reconstruction (Numpy, single thread) of the sinogram k of the memory map
+    storename of shape (angles, slices, pixels), centred by shift. Run on the processes
+    of a SlabPool, which read the sinogram themselves'''
+
+    store = np.memmap(storename, dtype='float32', mode='r', shape=tuple(shape))
+    sinogram = np.array(store[:,k,:].T)
+    del store
+
+    return iradon_cpu(sinogram, theta, output_size, shift=shift, workers=1)
+
+def _close(shm):
+
+    # Detach from a shared memory block
+    try:
+        shm.close()
+    except BufferError:
+        # The block is still referenced by the traceback of an error
+        pass
+
+def _process_shared(name, shape, params):
+
+    # Run in the pool: process the block held in the shared memory block name. The 
+    # transfer function, shared by all the blocks, is in the shared memory block 
+    # params['transfer_shm'] = (name, shape, dtype) rather than sent with each block
+    params = dict(params)
+    shared_transfer = params.pop('transfer_shm', None)
+    tshm = None
+    if shared_transfer is not None:
+        tshm = shared_memory.SharedMemory(name=shared_transfer[0])
+        params['transfer'] = np.ndarray(shared_transfer[1], dtype=shared_transfer[2], buffer=tshm.buf)
+
+    shm = shared_memory.SharedMemory(name=name)
+    block = np.ndarray(shape, dtype='float32', buffer=shm.buf)
+    try:
+        process_slab(block, fft_workers=1, **params)
+    finally:
+        del block
+        params.pop('transfer', None)
+        _close(shm)
+        if tshm is not None:
+            _close(tshm)
+
+def _release(shm):
+
+    # Free a shared memory block created by SlabPool
+    _close(shm)
+    shm.unlink()
+
+def _read_slabs(fnames, low, hi, shape, slab_rows, workers, shared, skip=None):
+
+    # Generator of (start, stop, block, shm) for the rows [low, hi), without the slabs
+    # for which skip(start) is true. With shared=True each block is read into a new 
+    # shared memory block shm, otherwise shm is None
+    for start in range(low, hi, slab_rows):
+        stop = min(start+slab_rows, hi)
+        if skip is not None and skip(start):
+            continue
+        if not shared:
+            yield start, stop, read_sinogram_slab(fnames, start, stop, workers=workers), None
+            continue
+
+        bshape = (stop-start, shape[0], shape[1])
+        shm = shared_memory.SharedMemory(create=True, size=4*int(np.prod(bshape)))
+        try:
+            read_sinogram_slab(fnames, start, stop, workers=workers, \
+                               out=np.ndarray(bshape, dtype='float32', buffer=shm.buf))
+        except BaseException:
+            _release(shm)
+            raise
+        yield start, stop, np.ndarray(bshape, dtype='float32', buffer=shm.buf), shm
+
+def _discard_slab(item):
+
+    # Release the shared memory of a block read by _read_slabs and never processed
+    if item[3] is not None:
+        _release(item[3])
+
+def _wait(future, idle=None):
+
+    # Result of a future. idle() is called while waiting
+    while idle is not None:
+        try:
+            return future.result(timeout=0.05)
+        except TimeoutError:
+            idle()
+
+    return future.result()
+
+def background(items, maxsize=2, idle=None, discard=None):
+
+    ''' Generator of the items of the iterable items, produced on a separate thread and
+    passed through a queue of at most maxsize items: producing the next items overlaps 
+    with the work done on the current one, and stops while the queue is full. 
+    idle() is called while the calling thread waits for an item. discard(item) is called
+    on the items produced but never yielded, when the generator is closed early.
+    Exceptions raised by the iterable are raised here'''
+
+    end = object()
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    if discard is not None:
+                        discard(item)
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            try:
+                item, error = q.get(timeout=0.05)
+            except queue.Empty:
+                if idle is not None:
+                    idle()
+                continue
+
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    finally:
+        stop.set()
+        thread.join()
+        while True:
+            try:
+                item, _ = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not end and discard is not None:
+                discard(item)
+
+class Writer(object):
+
+    ''' Last stage of a pipeline: write(*args) is run on a separate thread for each call
+    to put, in the order of the calls. At most maxsize calls are waiting, beyond that 
+    put blocks (calling idle() while it waits), which keeps the memory used by the
+    pipeline bounded. An error raised by write is raised again by the next put or
+    by close'''
+
+    def __init__(self, write, maxsize=2, idle=None):
+
+        self.write = write
+        self.idle = idle
+        self.error = None
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            # After an error the remaining calls are skipped
+            if self.error is None:
+                try:
+                    self.write(*args)
+                except Exception as e:
+                    self.error = e
+
+    def _put(self, args):
+
+        while True:
+            try:
+                self.queue.put(args, timeout=0.05)
+                return
+            except queue.Full:
+                if self.idle is not None:
+                    self.idle()
+
+    def put(self, *args):
+
+        ''' Queue the call write(*args)'''
+
+        if self.error is not None:
+            raise self.error
+        self._put(args)
+
+    def close(self):
+
+        ''' Wait for all the queued calls to be written'''
+
+        if self.thread is not None:
+            self._put(None)
+            while self.thread.is_alive():
+                self.thread.join(0.05)
+                if self.idle is not None:
+                    self.idle()
+            self.thread = None
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original error
+            try:
+                self.close()
+            except Exception:
+                pass
+
+class SlabPool(object):
+
+    ''' Persistent pool of processes running process_slab on blocks of sinograms.
+    The blocks are read directly into shared memory, so that only their names are
+    sent to the processes. With a single process, or without shared memory support,
+    the blocks are processed in the calling process. The processes are spawned rather
+    than forked: the pool starts while reading threads (and the batches of other 
+    scans) are running, and a fork could copy their locks in a held state. A spawned
+    process runs the main script again under the name __mp_main__, so the script 
+    must keep its GPU imports behind the __main__ guard'''
+
+    def __init__(self, processes=None):
+
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = None
+        if SHARED_MEMORY and self.processes > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, \
+                                                mp_context=multiprocessing.get_context('spawn'))
+
+    def slabs(self, fnames, low, hi, shape, slab_rows=16, prepare=None, idle=None, workers=None, \
+              prefetch=2, skip=None, **params):
+
+        ''' Generator of (start, stop, block) covering the rows [low, hi) of the scan in 
+        blocks of at most slab_rows sinograms, processed by process_slab with params and
+        yielded in the order of the rows. shape is the (pixels, angles) shape of a sinogram.
+        The blocks are read on a separate thread (workers is passed to read_sinogram_slab),
+        at most prefetch blocks ahead, while the previous ones are processed. 
+        prepare(block) is run in the calling thread before the block is sent to the pool 
+        (e.g. for the GPU deconvolution). At most processes+1 blocks are in the pool at
+        any time. idle() is called while the calling thread waits. The slabs for which
+        skip(start) is true are not read nor yielded (e.g. when resuming a batch). A 
+        transfer function in params is put once in shared memory for all the blocks'''
+
+        shared = self.executor is not None
+        tshm = None
+        if shared and params.get('transfer') is not None:
+            transfer = np.asarray(params['transfer'])
+            tshm = shared_memory.SharedMemory(create=True, size=max(transfer.nbytes, 1))
+            np.ndarray(transfer.shape, dtype=transfer.dtype, buffer=tshm.buf)[...] = transfer
+            params = dict(params, transfer=None, transfer_shm=(tshm.name, transfer.shape, transfer.dtype.str))
+
+        slabs = self._slabs(fnames, low, hi, shape, slab_rows, prepare, idle, workers, prefetch, skip, shared, params)
+        try:
+            for slab in slabs:
+                yield slab
+        finally:
+            # The blocks still in the pool are released before the transfer function
+            slabs.close()
+            if tshm is not None:
+                _release(tshm)
+
+    def _slabs(self, fnames, low, hi, shape, slab_rows, prepare, idle, workers, prefetch, skip, shared, params):
+
+        blocks = background(_read_slabs(fnames, low, hi, shape, slab_rows, workers, shared, skip), \
+                            maxsize=prefetch, idle=idle, discard=_discard_slab)
+
+        if not shared:
+            for start, stop, block, _ in blocks:
+                if prepare is not None:
+                    block = prepare(block)
+                yield start, stop, process_slab(block, **params)
+            return
+
+        pending = deque()
+        try:
+            for start, stop, block, shm in blocks:
+                try:
+                    if prepare is not None:
+                        block[...] = prepare(block)
+                    bshape = block.shape
+                    del block
+                    future = self.executor.submit(_process_shared, shm.name, bshape, params)
+                except BaseException:
+                    _release(shm)
+                    raise
+                pending.append((start, stop, bshape, shm, future))
+
+                if len(pending) > self.processes:
+                    yield self._collect(*pending.popleft(), idle=idle)
+
+            while pending:
+                yield self._collect(*pending.popleft(), idle=idle)
+
+        finally:
+            blocks.close()
+            # Release the blocks left over by an error or by a generator closed early
+            for _, _, _, shm, future in pending:
+                future.cancel()
+                try:
+                    future.result()
+                except Exception:
+                    pass
+                _release(shm)
+
+    def map(self, func, items, idle=None):
+
+        ''' Generator of func(*args) for the args in items, run on the processes of the
+        pool (in the calling process without them) and yielded in the order of the items.
+        At most processes+1 calls are pending. func must be a function of a module, and
+        its arguments and result small enough to be sent between the processes. 
+        idle() is called while the calling thread waits'''
+
+        if self.executor is None:
+            for args in items:
+                yield func(*args)
+            return
+
+        pending = deque()
+        try:
+            for args in items:
+                pending.append(self.executor.submit(func, *args))
+                if len(pending) > self.processes:
+                    yield _wait(pending.popleft(), idle)
+
+            while pending:
+                yield _wait(pending.popleft(), idle)
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _collect(self, start, stop, bshape, shm, future, idle=None):
+
+        # Wait for a block and copy it out of shared memory
+        try:
+            _wait(future, idle)
+            block = np.array(np.ndarray(bshape, dtype='float32', buffer=shm.buf))
+        finally:
+            _release(shm)
+
+        return start, stop, block
+
+    def close(self):
+
+        ''' Shut down the processes of the pool'''
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+class Journal(object):
+
+    ''' Completion journal of a batch, saved as JSON in fname. The journal holds the 
+    parameters of the batch and, for each finished slab, its last row and the range
+    of its values. A journal left by an interrupted batch is loaded when the 
+    parameters are the same, otherwise it is started again from scratch'''
+
+    def __init__(self, fname, params):
+
+        self.fname = fname
+        # Compare the parameters as they are stored in the file
+        self.params = json.loads(json.dumps(params))
+        self.slabs = {}
+
+        try:
+            with open(fname) as f:
+                saved = json.load(f)
+            if saved['params'] == self.params:
+                self.slabs = saved['slabs']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @property
+    def resumed(self):
+
+        ''' True if some slabs were finished by a previous run'''
+
+        return len(self.slabs) > 0
+
+    def done(self, start):
+
+        ''' True if the slab starting at row start is finished'''
+
+        return str(start) in self.slabs
+
+    def range(self):
+
+        ''' Minimum and maximum of the values of the finished slabs'''
+
+        if not self.slabs:
+            return np.inf, -np.inf
+        return min(s[1] for s in self.slabs.values()), max(s[2] for s in self.slabs.values())
+
+    def record(self, start, stop, vmin, vmax):
+
+        ''' Mark the slab [start, stop) as finished. The data of the slab must be
+        on disk before it is recorded'''
+
+        self.slabs[str(start)] = [stop, float(vmin), float(vmax)]
+        self.save()
+
+    def reset(self):
+
+        ''' Forget all the finished slabs'''
+
+        self.slabs = {}
+        self.save()
+
+    def save(self):
+
+        # Write a new file and rename it, so that a crash never leaves a truncated journal
+        tmp = self.fname+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'params': self.params, 'slabs': self.slabs}, f)
+        os.replace(tmp, self.fname)
+
+    def remove(self):
+
+        ''' Delete the journal once the batch is complete'''
+
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
@@ -3,7 +3,6 @@
 
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d, median_filter
-from scipy.misc import imresize
 import pywt
 
 def corrCoeff(arr1, arr2):
@@ -12,27 +11,241 @@ def corrCoeff(arr1, arr2):
            / np.sqrt(np.correlate(arr1, arr1))[0] \
            / np.sqrt(np.correlate(arr2, arr2))[0]
 
-def sino_centering(sinogram, span=50, fullrot=True):
+def sino_center(sinogram, fullrot=True, span=None):
 
-    ''' Automated misalignment compensation for OPT scans'''  
+    ''' Sub-pixel misalignment of the rotation axis of an OPT scan, and a confidence
+    value (the correlation coefficient at the optimum, up to 1). The shift s is the 
+    one for which np.roll(sinogram, s, axis=0) best matches the profile at 0 deg with 
+    the flipped profile at 180 deg (at the last angle for fullrot=False), i.e. the 
+    one that brings the rotation axis to the pixel nx//2, the centre used by the 
+    reconstructions. Rolling both profiles by s shifts their cross-correlation by 2s,
+    so all the shifts are scored at once by a single FFT correlation. span limits 
+    the search to the shifts in [-span//2, span//2)'''
 
     nx,nangles = sinogram.shape
 
-    coeff = np.zeros(span)
-    for i in range(span):
+    a = np.asarray(sinogram[:,0], dtype='float64')
+    if fullrot is True:
+        b = np.asarray(sinogram[::-1,nangles//2], dtype='float64')
+    else:
+        b = np.asarray(sinogram[::-1,-1], dtype='float64')
 
-        sinos = np.roll(sinogram, (i-span//2), axis=0)
-        if fullrot is True:
-            coeff[i] = corrCoeff(sinos[:,0], np.flipud(sinos[:,nangles//2]))
-        else:
-            coeff[i] = corrCoeff(sinos[:,0], np.flipud(sinos[:,-1]))
+    # Circular cross-correlation c[L] = sum_j a[j] b[j+L]; the shift s has lag 2s
+    c = np.fft.irfft(np.conj(np.fft.rfft(a))*np.fft.rfft(b), nx)
 
-    return np.argmax(coeff)-span//2
+    # Signed lags in (-nx/2, nx/2]
+    lags = np.arange(nx)
+    lags[lags > nx//2] -= nx
+    if span is not None:
+        c = np.where((lags >= 2*(-(span//2))) & (lags < 2*(span//2)), c, -np.inf)
+
+    k = int(np.argmax(c))
+
+    # Parabolic interpolation of the peak
+    delta = 0.0
+    c0, cm, cp = c[k], c[(k-1) % nx], c[(k+1) % nx]
+    if np.isfinite(cm) and np.isfinite(cp) and cm-2*c0+cp < 0:
+        delta = 0.5*(cm-cp)/(cm-2*c0+cp)
+
+    norm = np.sqrt(np.dot(a, a)*np.dot(b, b))
+    confidence = c0/norm if norm > 0 else 0.0
+
+    # The flip mirrors the profile about (nx-1)/2, half a pixel before nx//2 for even widths
+    return 0.5*(lags[k]+delta) + 0.5*(1 - nx % 2), float(confidence)
+
+def sino_centering(sinogram, span=None, fullrot=True):
+
+    ''' Automated misalignment compensation for OPT scans: the integer shift 
+    along the pixels that centres the rotation axis (see sino_center)'''  
+
+    shift, _ = sino_center(sinogram, fullrot, span)
+
+    return int(np.round(shift))
+
+def bin_detector(sinogram, factor):
+
+    ''' Sinogram (pixels, angles) binned by factor along the pixels: each pixel is the
+    mean of factor adjacent pixels. The last pixels are dropped when the width is not 
+    a multiple of factor'''
+
+    if factor <= 1:
+        return sinogram
+
+    n = sinogram.shape[0]//factor*factor
+    return sinogram[:n].reshape(n//factor, factor, -1).mean(axis=1)
+
+class RotationAxis(object):
+
+    ''' Linear model of the misalignment of the rotation axis along the rows of a scan:
+    shift(row) = center + tilt*row, with the shifts of sino_center'''
+
+    def __init__(self, center, tilt=0.0):
+
+        self.center = float(center)
+        self.tilt = float(tilt)
+
+    def shift(self, row):
+        return self.center + self.tilt*row
+
+    def integer_shift(self, row):
+        return int(np.round(self.shift(row)))
+
+def fit_rotation_axis(rows, shifts, weights=None, tolerance=1.0):
+
+    ''' RotationAxis fitted by weighted least squares to the shifts measured at some rows
+    (weights, e.g. the confidences of sino_center, default 1). The shifts further than 
+    tolerance pixels from a first fit are discarded and the fit is repeated. With a 
+    single row the axis is vertical (no tilt)'''
+
+    rows = np.asarray(rows, dtype='float64')
+    shifts = np.asarray(shifts, dtype='float64')
+    weights = np.ones(len(rows)) if weights is None else np.clip(np.asarray(weights, dtype='float64'), 0, None)
+    if not np.any(weights > 0):
+        weights = np.ones(len(rows))
+
+    def fit(keep):
+        w = weights*keep
+        if np.count_nonzero(w) < 2 or np.ptp(rows[w > 0]) == 0:
+            return np.sum(w*shifts)/np.sum(w), 0.0
+        tilt, center = np.polyfit(rows, shifts, 1, w=np.sqrt(w))
+        return center, tilt
+
+    center, tilt = fit(np.ones(len(rows)))
+    keep = np.abs(shifts - (center + tilt*rows)) <= tolerance
+    if np.any(keep & (weights > 0)) and not np.all(keep):
+        center, tilt = fit(keep.astype('float64'))
+
+    return RotationAxis(center, tilt)
 
 def psf1d_data(mask, shape):
     # This is already in Fourier space
     return np.outer(gaussian_filter1d(mask.astype('float32'), 100), np.ones(shape[1]))
 
+# Cache of the roll-off filters, keyed by (sinogram shape, pixel size, roll-off width)
+_rolloff_cache = {}
+
+def rolloff_filter(shape, pixel_size, w=0.3):
+
+    ''' Roll-off filter used in the deconvolution. The filter only depends on the
+    shape of the sinogram and on the pixel size, so it is computed once and 
+    cached for all the sinograms of a scan. The returned array is read-only'''
+
+    key = (tuple(shape), float(pixel_size), float(w))
+    try:
+        return _rolloff_cache[key]
+    except KeyError:
+        pass
+
+    # Define the angular range in rad (360 deg rotation)        
+    Phi = np.linspace(-shape[1]/(4*np.pi), shape[1]/(4*np.pi), shape[1], True) 
+
+    # Define the transverse horizontal coordinate in Fourier space       
+    Rx = np.linspace(-0.5/pixel_size, 0.5/pixel_size, shape[0], True)
+
+    # Rx may contain zero for odd sizes. The resulting inf/nan are handled
+    # as in the original element-wise definition of the filter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        line = np.outer(1.0/Rx, Phi)
+        Wr = np.where(line <= 0., 1.0, \
+                      np.where(line > w, 0.000001, np.cos( (np.pi/2)*np.abs(line)/w)))
+
+    Wr.flags.writeable = False
+    _rolloff_cache[key] = Wr
+
+    return Wr
+
+def rolloff_filter_half(shape, pixel_size, w=0.3):
+
+    ''' The n2//2+1 columns of the roll-off filter used with real-input FFTs, and the
+    same columns of the filter taken at the opposite frequencies. Both are cached'''
+
+    key = ('half', tuple(shape), float(pixel_size), float(w))
+    try:
+        return _rolloff_cache[key]
+    except KeyError:
+        pass
+
+    Wr = rolloff_filter(shape, pixel_size, w)
+    Wm = np.roll(np.flip(Wr, axis=(0,1)), 1, axis=(0,1))
+
+    halves = (Wr[:, :shape[1]//2+1].astype('float32'), Wm[:, :shape[1]//2+1].astype('float32'))
+    for h in halves:
+        h.flags.writeable = False
+    _rolloff_cache[key] = halves
+
+    return halves
+
+def psf_mask(vertps):
+
+    ''' Support of the data-driven PSF, from the power spectrum along the pixel axis.
+    vertps may hold one power spectrum per slice along its first axes'''
+
+    # Get the baseline (first 200 pixels) corresponding to noise
+    baseline = np.mean(vertps[..., :200], axis=-1, keepdims=True)
+
+    # Mask out everything that is smaller than the baseline + 50% after Gaussian smoothing with sigma=3
+    return gaussian_filter1d(vertps, 3, axis=-1) > 1.4*baseline 
+
+def wiener_filter(vertps, noise_level=0.05):
+
+    ''' Wiener filter of the PSF estimated from the power spectrum vertps, as a 
+    function of the pixel frequency only (fftshifted as the FT of the sinogram)'''
+
+    # Generate psf from data (same as psf1d_data, without the repetition along the angles)
+    psf_d = gaussian_filter1d(psf_mask(vertps).astype('float32'), 100, axis=-1).astype('float64')
+    psf_d = np.fft.fftshift(psf_d, axes=-1)
+
+    return np.conj(psf_d)/(psf_d*np.conj(psf_d)+noise_level)
+
+def deconvolution_filter(vertps, shape, pixel_size, noise_level=0.05):
+
+    ''' Transfer function of the deconvolution: the roll-off filter combined to 
+    the Wiener filter of the PSF estimated from the power spectrum vertps.
+    Multiplying the FT of a sinogram by this array gives the FT of the 
+    deconvolved sinogram'''
+
+    # Roll-off filter combined to Wiener filter
+    return rolloff_filter(shape, pixel_size)*wiener_filter(vertps, noise_level)[..., np.newaxis]
+
+def half_deconvolution_filter(vertps, shape, pixel_size, noise_level=0.05):
+
+    ''' Transfer function of the deconvolution on the n2//2+1 columns of real-input 
+    FFTs, in single precision. The filter is symmetrised so that 
+    irfft2(H_half*rfft2(x)) is the same as np.real(ifft2(H*fft2(x))) for a real x, 
+    with H = deconvolution_filter(vertps, shape, pixel_size, noise_level).
+    vertps may hold one power spectrum per slice: the result then has one filter 
+    per slice'''
+
+    Wh, Wm = rolloff_filter_half(shape[-2:], pixel_size)
+
+    # Wiener filter at the pixel frequencies k and -k
+    G = wiener_filter(vertps, noise_level).astype('float32')
+    Gm = np.roll(np.flip(G, axis=-1), 1, axis=-1)
+
+    return 0.5*(Wh*G[..., np.newaxis] + Wm*Gm[..., np.newaxis])
+
+def vertical_power_spectrum(fhalf, n2):
+
+    ''' Power spectrum in the vertical direction (pixel axis) from the half spectrum 
+    of a real-input FFT (rfft2) along the last two axes. The result is the same as 
+    np.mean(np.abs(np.fft.fftshift(np.fft.fft2(x))), axis=1) for a 2D sinogram x
+    of n2 angles'''
+
+    a = np.abs(fhalf)
+
+    # The columns missing from the half spectrum are the mirrored columns 1 ... n2-n2//2-1
+    # taken at the opposite frequency along the pixel axis
+    mirror = np.roll(np.flip(a[..., 1:n2-n2//2], axis=-2), 1, axis=-2)
+    vertps = (np.sum(a, axis=-1) + np.sum(mirror, axis=-1))/n2
+
+    return np.fft.fftshift(vertps, axes=-1)
+
+def clear_filter_cache():
+
+    ''' Release the cached filters (e.g. when a new scan is loaded)'''
+
+    _rolloff_cache.clear()
+
 def remove_blob_sino(sinogram, sigma, thresh):
   
     sinom = median_filter(sinogram, size=int(sigma))
@@ -4,8 +4,9 @@ import glob
 import sys
 import platform
 import os
-from shutil import copyfile
-import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from skimage.external import tifffile as tif
 from skimage.restoration import denoise_tv_chambolle
@@ -13,31 +14,44 @@ from skimage.restoration import denoise_tv_chambolle
 if platform.system() == 'Windows':
     import winsound
 
-# Handle the imports of the GPU modules
+# Handle the imports of the GPU modules. The processes of the batch pool are
+# spawned and run this file again as __mp_main__: they only process slabs on the
+# CPU, so they skip the GPU context and astra
 GPU = False
 CPU = False
-try:
-    import pycuda.autoinit
-    from deconvolution_GPUutilities import runDeconvolutionGPU
-    GPU = True
-except ImportError:
+AST = False
+if __name__ == '__main__':
+    try:
+        import pycuda.autoinit
+        from deconvolution_GPUutilities import runDeconvolutionGPU
+        GPU = True
+    except ImportError:
 
-    from deconvolution_CPUutilities import runDeconvolutionCPU
-    CPU = True
+        from deconvolution_CPUutilities import runDeconvolutionCPU
+        CPU = True
 
-# Handle the import of the ASTRA Toolbox module
-AST = False
-if GPU is True:
+    # Handle the import of the ASTRA Toolbox module. Without a GPU the CPU FBP of
+    # astra is used, and without astra the Numpy implementation
     try:
         import astra
-        from astra_GPUutilities import iradon_astra
+        from astra_GPUutilities import iradon_astra, clear_astra_cache
         AST = True
     except:
-        from skimage.transform import iradon
-else:
-    from skimage.transform import iradon
+        pass
+from fbp_CPUutilities import iradon_cpu, clear_fbp_cache
+
+from common_utilities import remove_blob_sino_wavelet, clear_filter_cache, bin_detector, sino_center
+from io_utilities import read_sinogram, read_sinogram_rows, VOLUME_FORMATS, IO_WORKERS, SinogramCache
+from batch_utilities import SlabPool
+from deconvolution_batch import Scan, DeconvolutionBatch, BatchCancelled, estimate_rotation_axis, clear_axis_cache
 
-from common_utilities import sino_centering, remove_blob_sino_wavelet
+# Rows read ahead on each side of the selected slice
+PREFETCH_ROWS = 8
+
+def _worker_init():
+    # The GPU context of pycuda.autoinit is made current on the worker thread too
+    if 'pycuda.autoinit' in sys.modules:
+        sys.modules['pycuda.autoinit'].context.push()
 
 if sys.version_info[0] < 3:
     import Tkinter as Tk
@@ -347,6 +361,33 @@ class deconvolution():
         self.sizeSBlabel = Tk.Label(text=" Size of the reconstructed slice", relief='flat',fg='black')
         self.sizeSBlabel.grid(row=8, column=0, sticky='w', padx=50, pady=3)
 
+        # Create spinbox containing the angular step of the quick look (every k-th projection)
+        self.stepSpinbox = Tk.Spinbox(self.root, width=5, values=(1, 2, 4, 8, 16))
+        self.stepSpinbox.grid(row=9, column=0, sticky='w', padx=5, pady=3)
+        self.stepSpinbox.delete(0,5) # delete all characters that were prep-populated
+        self.stepSpinbox.insert(0,4) # Insert starting point
+
+        # Create spinbox label
+        self.stepSBlabel = Tk.Label(text=" Quick look: angular step", relief='flat',fg='black')
+        self.stepSBlabel.grid(row=9, column=0, sticky='w', padx=50, pady=3)
+
+        # Create spinbox containing the detector binning of the quick look
+        self.binSpinbox = Tk.Spinbox(self.root, width=5, values=(1, 2, 4))
+        self.binSpinbox.grid(row=10, column=0, sticky='w', padx=5, pady=3)
+        self.binSpinbox.delete(0,5) # delete all characters that were prep-populated
+        self.binSpinbox.insert(0,2) # Insert starting point
+
+        # Create spinbox label
+        self.binSBlabel = Tk.Label(text=" Quick look: detector binning", relief='flat',fg='black')
+        self.binSBlabel.grid(row=10, column=0, sticky='w', padx=50, pady=3)
+
+        # Create the quick look button (coarse slice) and the refine button (full quality preview)
+        self.quickButton = Tk.Button(self.root, text='Quick Look', bg = '#b2b2b2', \
+                                     command=lambda: self.loadSino(quick=True))
+        self.quickButton.grid(row=11, column=0, sticky='w', padx=5, pady=5)
+        self.refineButton = Tk.Button(self.root, text='Refine', bg = '#b2b2b2', command=self.loadSino)
+        self.refineButton.grid(row=11, column=0, sticky='w', padx=90, pady=5)
+
         ############################################################################################
 
 
@@ -445,6 +486,10 @@ class deconvolution():
             command=self.run_dec_series)
         self.rundecButton.grid(row=6, column=6, sticky='e', padx=5, pady=10)
 
+        # Create the button cancelling the running batch at the end of the current slab
+        self.cancelButton = Tk.Button(self.root, text='Cancel', bg = '#b2b2b2', command=self.cancelBatch)
+        self.cancelButton.grid(row=11, column=6, sticky='e', padx=5, pady=5)
+
         # Create spinbox containing the value of the bottom slice to reconstruct
         self.botSpinbox = Tk.Spinbox(self.root, width=5, from_=0, to=2000, increment=1)
         self.botSpinbox.grid(row=7, column=6, sticky='e', padx=5, pady=3)
@@ -465,6 +510,16 @@ class deconvolution():
         self.topSBlabel = Tk.Label(text="Upper slice   ", relief='flat',fg='black')
         self.topSBlabel.grid(row=8, column=6, sticky='e', padx=50, pady=3)
 
+        # Create spinbox containing the number of threads reading the projections
+        self.ioSpinbox = Tk.Spinbox(self.root, width=5, from_=1, to=32, increment=1)
+        self.ioSpinbox.grid(row=9, column=6, sticky='e', padx=5, pady=3)
+        self.ioSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.ioSpinbox.insert(0,IO_WORKERS) # Insert starting value
+
+        # Create spinbox label
+        self.ioSBlabel = Tk.Label(text="Read threads   ", relief='flat',fg='black')
+        self.ioSBlabel.grid(row=9, column=6, sticky='e', padx=50, pady=3)
+
 
         # Create the run deconvolution progress bar
         self.progr2 = Progressbar(self.root, orient=Tk.HORIZONTAL, length=80, mode='determinate')
@@ -478,6 +533,41 @@ class deconvolution():
         self.cbutton2 = Tk.Checkbutton(self.root, text="Blob removal", variable=self.cb2var)
         self.cbutton2.grid(row=8, column=7, sticky='e', padx=10, pady=0)
 
+        # Estimate the PSF once for the whole scan instead of slice by slice
+        self.cb3var =Tk.IntVar()
+        self.cbutton3 = Tk.Checkbutton(self.root, text="Scan PSF       ", variable=self.cb3var)
+        self.cbutton3.grid(row=9, column=7, sticky='e', padx=8, pady=0)
+
+        # Create the menu of the output formats of the processed scan
+        self.formatvar = Tk.StringVar()
+        self.formatvar.set(VOLUME_FORMATS[0])
+        self.formatMenu = Tk.OptionMenu(self.root, self.formatvar, *VOLUME_FORMATS)
+        self.formatMenu.grid(row=10, column=6, sticky='e', padx=5, pady=3)
+
+        # Create menu label
+        self.formatLabel = Tk.Label(text="Output   ", relief='flat',fg='black')
+        self.formatLabel.grid(row=10, column=6, sticky='e', padx=80, pady=3)
+
+        # Save the processed data as float32 instead of rescaling them to 16-bit
+        self.cb4var =Tk.IntVar()
+        self.cbutton4 = Tk.Checkbutton(self.root, text="Float32        ", variable=self.cb4var)
+        self.cbutton4.grid(row=10, column=7, sticky='e', padx=8, pady=0)
+
+        # Also reconstruct the processed slices (over the full detector width)
+        self.cb5var =Tk.IntVar()
+        self.cbutton5 = Tk.Checkbutton(self.root, text="Reconstruct   ", variable=self.cb5var)
+        self.cbutton5.grid(row=11, column=7, sticky='e', padx=8, pady=0)
+
+        # Create spinbox containing the deflate compression level of the output (0 = uncompressed)
+        self.compressSpinbox = Tk.Spinbox(self.root, width=5, from_=0, to=9, increment=1)
+        self.compressSpinbox.grid(row=12, column=6, sticky='e', padx=5, pady=3)
+        self.compressSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.compressSpinbox.insert(0,0) # Insert starting value
+
+        # Create spinbox label
+        self.compressSBlabel = Tk.Label(text="Compression   ", relief='flat',fg='black')
+        self.compressSBlabel.grid(row=12, column=6, sticky='e', padx=50, pady=3)
+
 
         #####################################################################################
         # Pulldown menu
@@ -502,12 +592,32 @@ class deconvolution():
         #######################################################################################
         #######################################################################################
 
+        # Sinograms already loaded for the preview, revisiting a row does not read the projections again
+        self.sinoCache = SinogramCache()
+        # Background reads of the rows around the selected one, into the cache
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.prefetch, self.prefetchKeys = None, ()
+
+        # Loads, previews and batches run one at a time on the worker thread. The worker 
+        # posts its progress and results to the events queue, polled by the main loop
+        self.worker = ThreadPoolExecutor(max_workers=1, initializer=_worker_init)
+        self.events = queue.Queue()
+        self.task = None
+        self.cancel = threading.Event()
+        self.root.after(50, self.pollEvents)
 
         self.root.mainloop()
 
 
 
     def _quit(self):
+        # Stop a running batch at the next slab, the worker finishes on its own
+        self.cancel.set()
+        self.worker.shutdown(wait=False)
+        self.prefetcher.shutdown(wait=False)
+        # Shut down the processes of the batch pool, unless a batch is still using them
+        if getattr(self, 'pool', None) is not None and (self.task is None or self.task.done()):
+            self.pool.close()
     	# stops mainloop
         self.root.quit()
         # Destroy all windows, necessary on Windows to prevent Fatal Python Error
@@ -544,6 +654,7 @@ class deconvolution():
                 return
             else:
                 self.coords.append((self.ix, self.iy))
+                self.prefetchRows()
 
     def AreYouSure(self):
         self.root.update_idletasks()
@@ -760,6 +871,14 @@ class deconvolution():
                 # Read the pixel size
                 self.pix = float(self.logtext[5].split('=')[-1])
 
+                # Filters and rotation axis cached for the previous scan are no longer needed
+                clear_filter_cache()
+                clear_axis_cache()
+                clear_fbp_cache()
+                self.sinoCache.clear()
+                if AST is True:
+                    clear_astra_cache()
+
                 # Read if the scan is 360 (YES) or 180 (NO)
                 self.whichrotation = self.logtext[14].split('=')[-1]
                 if self.whichrotation == 'NO':
@@ -774,6 +893,7 @@ class deconvolution():
                     self.nx, self.ny = self.r.shape
                     # Get the number of images
                     self.nangles = len(self.fnames)
+                    self.step, self.binning, self.nload = 1, 1, self.nangles
 
                     # Display the image
                     self.ax1.imshow(self.r, cmap='gray_r')
@@ -799,25 +919,182 @@ class deconvolution():
             self.stringvar.set(" ")
             self.stringvar.set("No directory selected. Operation cancelled.")
 
-    def runFBP(self, sinog):
-        ''' Filtered Back Projection routine'''
+    def runFBP(self, sinog, settings):
+        ''' Filtered Back Projection routine. The sinogram may be decimated by the
+        quick look (self.step, self.binning): the shift (in full resolution pixels), 
+        the angles and the output size are scaled accordingly. settings are those 
+        of previewSettings. Runs on the worker thread'''
 
-        if int(self.cenSpinbox.get()) == 0:
-            self.shift = sino_centering(sinog)
+        if settings['center'] == 0:
+            if self.binning > 1 or self.step > 1:
+                # Centre the coarse sinogram itself rather than reading the rows of the axis model
+                self.shift = int(np.round(sino_center(sinog)[0]*self.binning))
+            else:
+                self.shift = self.axisShift(settings['row'], settings['workers'])
         else:
-            self.shift = int(self.cenSpinbox.get())
+            self.shift = settings['center']
+
+        theta = np.linspace(0,360, len(self.fnames))[::self.step]
+        size = settings['size']//self.binning
         if AST is True:
-            slic = iradon_astra(np.roll(sinog,self.shift, axis=0), \
-                         theta = np.linspace(0,360, len(self.fnames)), output_size = int(self.sizeSpinbox.get()))
+            slic = iradon_astra(np.roll(sinog,int(np.round(float(self.shift)/self.binning)), axis=0), \
+                         theta = theta, output_size = size, gpu = GPU)
         else:
-            slic = iradon(np.roll(sinog,self.shift, axis=0), \
-                         theta = np.linspace(0,360, len(self.fnames)), output_size = int(self.sizeSpinbox.get()))
+            # The shift is applied in the cached geometry of the back-projection
+            slic = iradon_cpu(sinog, theta = theta, output_size = size, shift = float(self.shift)/self.binning)
+
+        return slic
+
+    def showCenter(self):
 
         # Update value of the spinbox
         self.cenSpinbox.delete(0,5)
         self.cenSpinbox.insert(0,self.shift)
 
-        return slic
+    def previewSettings(self):
+
+        ''' Settings of the previews, read from the widgets on the main thread
+        before the work is handed to the worker'''
+
+        return {'row': int(self.iy), 'center': int(self.cenSpinbox.get()), 'size': int(self.sizeSpinbox.get()), \
+                'noise': float(self.noiseSpinbox.get()), 'sigma': int(self.sigmaSpinbox.get()), \
+                'workers': self.ioWorkers()}
+
+    def runTask(self, work, done=None):
+
+        ''' Run work() on the worker thread, then done(result) on the main thread.
+        One task runs at a time: a request while the worker is busy is refused.
+        Returns True if the task is started'''
+
+        if self.task is not None and not self.task.done():
+            self.messageLab.config(bg="white")
+            winsound.PlaySound("*", winsound.SND_ALIAS)
+            self.stringvar.set(" ")
+            self.stringvar.set("Busy, wait for the running task!")
+            self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
+            return False
+
+        self.task = self.worker.submit(work)
+        self.task.add_done_callback(lambda future: self.events.put(('done', future, done)))
+
+        return True
+
+    def pollEvents(self):
+
+        ''' Show the progress and the results posted by the worker, then poll again.
+        Only the last message and the last value of each progress bar are shown'''
+
+        message, bars, finished = None, {}, []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'progress':
+                message = event[2]
+                if event[1] is not None:
+                    bars[event[1]] = event[3]
+            else:
+                finished.append(event[1:])
+
+        if message is not None:
+            self.stringvar.set(message)
+        for bar, value in bars.items():
+            bar['value'] = value
+
+        for future, done in finished:
+            error = future.exception()
+            if isinstance(error, BatchCancelled):
+                self.stringvar.set(" ")
+                self.stringvar.set("Cancelled! Processing the scan again resumes the batch")
+            elif error is not None:
+                self.messageLab.config(bg="white")
+                winsound.PlaySound("*", winsound.SND_ALIAS)
+                self.stringvar.set(" ")
+                self.stringvar.set("Error: "+str(error))
+                self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
+            elif done is not None:
+                done(future.result())
+
+        self.root.after(50, self.pollEvents)
+
+    def cancelBatch(self):
+
+        # Stop the running batch at the end of the current slab (previews are not cancelled)
+        if self.task is not None and not self.task.done() and not self.cancel.is_set():
+            self.cancel.set()
+            self.stringvar.set(" ")
+            self.stringvar.set("Cancelling at the end of the current slab...")
+
+    def readDrift(self):
+
+        # Check if the csv file containing the xy correction is present
+        self.base = os.path.basename(self.fnames[0]).index('_0')
+        self.bn =  os.path.basename(self.fnames[0])[:self.base+1]
+        self.fol = os.path.dirname(self.fnames[0])
+        try:
+
+            self.xy = pd.read_csv(self.fol+"/"+self.bn+"_TS.csv", skiprows=2)
+            self.xs = self.xy[" Y1"].values
+            self.ys = self.xy[" Y2"].values
+            self.message = "Preview reconstruction with xy correction "
+
+        except:
+            self.xs, self.ys = None, None
+            self.message = "Preview reconstruction "
+
+    def prefetchRows(self):
+
+        ''' Read in the background the full quality sinograms of the selected row and
+        of PREFETCH_ROWS rows on each side into the sinogram cache, in a single pass 
+        over the projections. A prefetch not started yet is replaced by the new one'''
+
+        self.readDrift()
+        row = int(self.iy)
+        keys = [(self.fol, k, self.xs is not None, 1, 1) for k in range(row-PREFETCH_ROWS, row+PREFETCH_ROWS+1)]
+        keys = [key for key in keys if 0 <= key[1] < self.nx and key not in self.sinoCache]
+        if not keys:
+            return
+
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+        self.prefetchKeys = keys
+        self.prefetch = self.prefetcher.submit(self._prefetch, list(self.fnames), keys, self.xs, self.ys, \
+                                               self.ioWorkers())
+
+    def _prefetch(self, fnames, keys, xs, ys, workers):
+
+        # Runs on the prefetch thread: no access to the widgets
+        block = read_sinogram_rows(fnames, [key[1] for key in keys], workers=workers, xshifts=xs, yshifts=ys)
+        for key, sinogram in zip(keys, block):
+            self.sinoCache.put(key, sinogram)
+
+    def waitPrefetch(self, key):
+
+        ''' Wait for the prefetch reading key, if any (on the worker thread).
+        Returns True if the sinogram is then in the cache'''
+
+        prefetch = self.prefetch
+        if prefetch is None or key not in self.prefetchKeys:
+            return False
+
+        self.events.put(('progress', None, self.message+"(reading neighbouring rows)", None))
+        try:
+            prefetch.result()
+        except Exception:
+            # Cancelled or failed: the row is read again
+            return False
+
+        return key in self.sinoCache
+
+    def axisShift(self, row, workers=None):
+
+        ''' Shift centring the rotation axis at row. The axis model is fitted once per 
+        scan (and xy correction) and reused by all the previews'''
+
+        axis = estimate_rotation_axis(self.fnames, self.nx, xshifts=self.xs, yshifts=self.ys, workers=workers)
+
+        return axis.integer_shift(row)
 
     def denoise(self, array):
 
@@ -828,19 +1105,36 @@ class deconvolution():
 
         return array_denoise
 
-    def runDec(self, sinog):
+    def runDec(self, sinog, noise, transfer=None):
 
-        self.noise = float(self.noiseSpinbox.get())
+        # The pixels of a binned preview sinogram are larger
+        self.noise = noise
         if 'pycuda.autoinit' in sys.modules:
-            decsino = runDeconvolutionGPU(sinog, self.pix, noise_level=self.noise)
+            decsino = runDeconvolutionGPU(sinog, self.pix*self.binning, noise_level=self.noise, transfer=transfer)
         else:
-            decsino = runDeconvolutionCPU(sinog, self.pix, noise_level=self.noise)
+            decsino = runDeconvolutionCPU(sinog, self.pix*self.binning, noise_level=self.noise, transfer=transfer)
 
         return decsino
 
-    def loadSino(self):
+    def ioWorkers(self):
 
-        # Load sinogram data at the specified position, run FBP and display data
+        ''' Number of threads reading the projections, as set in the GUI'''
+
+        try:
+            return max(int(self.ioSpinbox.get()), 1)
+        except ValueError:
+            return IO_WORKERS
+
+    def previewProgress(self, i):
+
+        # Update the message and the progress bar (posted to the main thread)
+        self.events.put(('progress', self.progr1, self.message+str(int(100.0*(i+1)/self.nload))+"% complete", \
+                         int(100*(i+1)/self.nload)))
+
+    def loadSino(self, quick=False):
+
+        # Load sinogram data at the specified position, run FBP and display data.
+        # The quick look reads every k-th projection and bins the detector for a coarse slice
 
         # Check if data are loaded
         try:
@@ -859,71 +1153,76 @@ class deconvolution():
                 # Reset the text to null
                 self.stringvar.set(" ")
                 self.root.update_idletasks()
-                # Allocate the array for the sinogram
-                self.sino = np.zeros((self.ny, self.nangles))
+                # Decimation of the preview: angular step and detector binning (1 for full quality)
+                if quick:
+                    step, binning = int(self.stepSpinbox.get()), int(self.binSpinbox.get())
+                else:
+                    step, binning = 1, 1
 
-                # Check if the csv file containing the xy correction is present
-                self.base = os.path.basename(self.fnames[0]).index('_0')
-                self.bn =  os.path.basename(self.fnames[0])[:self.base+1]
-                self.fol = os.path.dirname(self.fnames[0])
-                try:
+                self.readDrift()
+                if quick:
+                    self.message = "Quick look "
 
-                    self.xy = pd.read_csv(self.fol+"/"+self.bn+"_TS.csv", skiprows=2)
-                    self.xs = self.xy[" Y1"].values
-                    self.ys = self.xy[" Y2"].values
-                    for i,j in enumerate(self.fnames):
-                        # Load image and assign it to sinogram line
-                        #self.sino[:,i] = tif.imread(j)[int(self.iy),:]
-                        self.sino[:,i] = np.roll(np.roll(tif.imread(j), int(self.xs[i]), axis=1), \
-                                          int(self.ys[i]), axis=0)[int(self.iy),:]
+                # Read and reconstruct on the worker, display once done
+                settings = self.previewSettings()
+                self.runTask(lambda: self._loadSino(step, binning, settings), self.showSlice)
 
-                        # Update the message
-                        self.stringvar.set("Preview reconstruction with xy correction "+str(int(100.0*(i+1)/len(self.fnames)))+"% complete")
-                        self.progr1['value'] = int(100*(i+1)/len(self.fnames))
-                        self.root.update_idletasks()
-                        self.root.update()
+        except AttributeError:
+            self.messageLab.config(bg="white")
+            winsound.PlaySound("*", winsound.SND_ALIAS)
+            self.stringvar.set(" ")
+            self.stringvar.set("Data not loaded yet!")
+            self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
 
-                except:
-                    for i,j in enumerate(self.fnames):
-                        # Load image and assign it to sinogram line
-                        self.sino[:,i] = tif.imread(j)[int(self.iy),:]
+    def _loadSino(self, step, binning, settings):
 
-                        # Update the message
-                        self.stringvar.set("Preview reconstruction "+str(int(100.0*(i+1)/len(self.fnames)))+"% complete")
-                        self.progr1['value'] = int(100*(i+1)/len(self.fnames))
-                        self.root.update_idletasks()
-                        self.root.update()
+        # Runs on the worker thread: no access to the widgets
+        self.step, self.binning = step, binning
+        fnames = self.fnames[::self.step]
+        self.nload = len(fnames)
+        xs = None if self.xs is None else self.xs[::self.step]
+        ys = None if self.ys is None else self.ys[::self.step]
 
-                # Run FBP reconstruction
-                self.slice = self.runFBP(self.sino)
+        # The same row of the same scan with the same corrections and decimation is taken from the cache
+        key = (self.fol, settings['row'], self.xs is not None, self.step, self.binning)
+        sino = self.sinoCache.get(key)
+        if sino is None and self.waitPrefetch(key):
+            sino = self.sinoCache.get(key)
+        if sino is None:
+            # Load only the selected row of each image and assign it to the sinogram line.
+            # The xy correction is applied to the row instead of the whole image
+            sino = read_sinogram(fnames, settings['row'], xshifts=xs, yshifts=ys, \
+                                 callback=self.previewProgress, workers=settings['workers'])
+            sino = bin_detector(sino, self.binning)
+            self.sinoCache.put(key, sino)
+        self.sino = sino
 
-                # Display the reconstructed slice
-                self.ax2.imshow(self.slice, cmap='gray_r')
-                self.fig2.canvas.draw()
+        # Run FBP reconstruction
+        return self.runFBP(self.sino, settings)
 
+    def showSlice(self, slic):
 
-                # Update spinboxes
-                self.minCsliceSpinbox['from_'] = min( int(2*np.min(self.slice)), int(0.5*np.min(self.slice)))
-                self.maxCsliceSpinbox['from_'] = min( int(2*np.min(self.slice)), int(0.5*np.min(self.slice)))
-                self.minCsliceSpinbox['to_'] = max(int(2*np.max(self.slice)), int(0.5*np.max(self.slice)))
-                self.maxCsliceSpinbox['to_'] = max(int(2*np.max(self.slice)), int(0.5*np.max(self.slice)))
+        self.slice = slic
+        self.showCenter()
 
-                self.minCsliceSpinbox['increment'] = (np.max(self.slice)-np.min(self.slice))/255
-                self.maxCsliceSpinbox['increment'] = (np.max(self.slice)-np.min(self.slice))/255
+        # Display the reconstructed slice
+        self.ax2.imshow(self.slice, cmap='gray_r')
+        self.fig2.canvas.draw()
 
-                self.minCsliceSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.minCsliceSpinbox.insert(0,int(np.min(self.slice))) # Insert starting point
-                self.maxCsliceSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.maxCsliceSpinbox.insert(0,int(np.max(self.slice))) # Insert starting point
 
+        # Update spinboxes
+        self.minCsliceSpinbox['from_'] = min( int(2*np.min(self.slice)), int(0.5*np.min(self.slice)))
+        self.maxCsliceSpinbox['from_'] = min( int(2*np.min(self.slice)), int(0.5*np.min(self.slice)))
+        self.minCsliceSpinbox['to_'] = max(int(2*np.max(self.slice)), int(0.5*np.max(self.slice)))
+        self.maxCsliceSpinbox['to_'] = max(int(2*np.max(self.slice)), int(0.5*np.max(self.slice)))
 
+        self.minCsliceSpinbox['increment'] = (np.max(self.slice)-np.min(self.slice))/255
+        self.maxCsliceSpinbox['increment'] = (np.max(self.slice)-np.min(self.slice))/255
 
-        except AttributeError:
-            self.messageLab.config(bg="white")
-            winsound.PlaySound("*", winsound.SND_ALIAS)
-            self.stringvar.set(" ")
-            self.stringvar.set("Data not loaded yet!")
-            self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
+        self.minCsliceSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.minCsliceSpinbox.insert(0,int(np.min(self.slice))) # Insert starting point
+        self.maxCsliceSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.maxCsliceSpinbox.insert(0,int(np.max(self.slice))) # Insert starting point
 
 
     def dec_radon(self):
@@ -954,100 +1253,92 @@ class deconvolution():
 
             else:
 
-                # Run deconvolution
-                self.decsino = self.runDec(self.sino)
+                settings = self.previewSettings()
+
+                def work():
+                    # Run deconvolution
+                    self.decsino = self.runDec(self.sino, settings['noise'])
+
+                    # Run FBP reconstruction
+                    return self.runFBP(self.decsino, settings)
+
+                self.runTask(work, self.showDecSlice)
+
+    def showDecSlice(self, slic):
+
+        self.decslice = slic
+        self.showCenter()
+
+        # Denoising
+        self.decdenslice = self.decslice#self.denoise(self.decslice)
+
+        # Display the reconstructed slice
+        self.ax3.imshow(self.decdenslice, cmap='gray_r')
+        self.fig3.canvas.draw()
 
-                # Run FBP reconstruction
-                self.decslice = self.runFBP(self.decsino)
+        # Update spinboxes
+        self.minCdecSpinbox['from_'] = min( 2*np.min(self.decdenslice), 0.5*np.min(self.decdenslice))
+        self.maxCdecSpinbox['from_'] = min( 2*np.min(self.decdenslice), 0.5*np.min(self.decdenslice))
+        self.minCdecSpinbox['to_'] = max(2*np.max(self.decdenslice), 0.5*np.max(self.decdenslice))
+        self.maxCdecSpinbox['to_'] = max(2*np.max(self.decdenslice), 0.5*np.max(self.decdenslice))
 
-                # Denoising
-                self.decdenslice = self.decslice#self.denoise(self.decslice)
+        self.minCdecSpinbox['increment'] = (np.max(self.decdenslice)-np.min(self.decdenslice))/255
+        self.maxCdecSpinbox['increment'] = (np.max(self.decdenslice)-np.min(self.decdenslice))/255
 
-                # Display the reconstructed slice
-                self.ax3.imshow(self.decdenslice, cmap='gray_r')
-                self.fig3.canvas.draw()
+        self.minCdecSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.minCdecSpinbox.insert(0,int(np.min(self.decdenslice))) # Insert starting point
+        self.maxCdecSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.maxCdecSpinbox.insert(0,int(np.max(self.decdenslice))) # Insert starting point
 
-                # Update spinboxes
-                self.minCdecSpinbox['from_'] = min( 2*np.min(self.decdenslice), 0.5*np.min(self.decdenslice))
-                self.maxCdecSpinbox['from_'] = min( 2*np.min(self.decdenslice), 0.5*np.min(self.decdenslice))
-                self.minCdecSpinbox['to_'] = max(2*np.max(self.decdenslice), 0.5*np.max(self.decdenslice))
-                self.maxCdecSpinbox['to_'] = max(2*np.max(self.decdenslice), 0.5*np.max(self.decdenslice))
 
-                self.minCdecSpinbox['increment'] = (np.max(self.decdenslice)-np.min(self.decdenslice))/255
-                self.maxCdecSpinbox['increment'] = (np.max(self.decdenslice)-np.min(self.decdenslice))/255
 
-                self.minCdecSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.minCdecSpinbox.insert(0,int(np.min(self.decdenslice))) # Insert starting point
-                self.maxCdecSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.maxCdecSpinbox.insert(0,int(np.max(self.decdenslice))) # Insert starting point
 
+    def batchProgress(self, message, fraction):
 
+        ''' Progress of the batch, posted to the main thread: the message and the 
+        progress bar'''
 
+        if fraction is None:
+            self.events.put(('progress', None, message, None))
+        else:
+            self.events.put(('progress', self.progr2, message+" "+str(int(100.0*fraction))+"% complete", \
+                             int(100.0*fraction)))
 
     def dec_series(self):
 
-        # Copy the log file across
-        copyfile(self.log, self.dec_dir+'\\'+os.path.basename(self.log))
-
-        # create memmap
-        self.sinomm = np.memmap(self.dec_dir+'sino_memmap', dtype='float32', \
-                      mode='w+', shape=(self.sino.shape[0], self.sino.shape[1], self.hi-self.low))
-
-        # Load sinogram
-        for k in range(self.low, self.hi, 1):
-            #print(k)
-
-            self.newsino = np.zeros_like(self.sino)
-            for i,j in enumerate(self.fnames):
-                self.newsino[:,i] = tif.imread(j)[k,:]
-
-            self.decnewsino = np.copy(self.newsino)
-
-            if int(self.cb1var.get()) == 1:
-                # Deconvolve sinogram
-                self.decnewsino = self.runDec(self.decnewsino)
-                #print("deconvolution")
-
-            if int(self.cb2var.get()) == 1:
-                # Remove blob
-                self.decnewsino = remove_blob_sino_wavelet(self.decnewsino, sigma=int(self.sigmaSpinbox.get()))
-                #print("blob removal")
-
-            # Populate the memory map with the deconcolved sino data
-            self.sinomm[:,:,k-self.low] = self.decnewsino.astype('float32')
-
-            # Update progress bar
-            self.progr2['value'] = int(100.0*(k-self.low+1)/self.sinomm.shape[2])
-            self.root.update_idletasks()
-            self.stringvar.set("Saving deconvolved sinograms "+str(int(100.0*(k-self.low+1)/self.sinomm.shape[2]))+"% complete" )
-            self.root.update_idletasks()
-            self.root.update()
-
-        # Get the range of the deconvolved sinogram (it may be larger than 16-bit)
-        self.sinommrange = np.abs(np.max(self.sinomm)-np.min(self.sinomm))
-        #print("corrected sinogram range: "+str(self.sinommrange))
-        # Set the minimum to zero
-        self.sinomm = self.sinomm - np.min(self.sinomm)
-        # Rescale to 16-bit if required
-        if self.sinommrange > 65537.0:
-            self.sinomm = self.sinomm/(self.sinommrange/65000)
-
-        # Save projections (reslice the memory map)
-        for k in range(self.nangles):
-            self.newproj = (self.sinomm[:,k,:].T).astype('uint16')
-            tif.imsave(self.dec_dir+os.path.basename(self.log)[:-4]+str(k).zfill(4)+'.tif', self.newproj)
-
-
-            # Update progress bar
-            self.progr2['value'] = int(100.0*(k+1)/self.nangles)
-            self.root.update_idletasks()
-            self.stringvar.set("Saving new projections "+str(int(100.0*(k+1)/self.nangles))+"% complete" )
-            self.root.update_idletasks()
-            self.root.update()
-
-        # Delete memory map
-        del self.sinomm
-        os.remove(self.dec_dir+'sino_memmap')
+        # The pool is started on the first batch and reused afterwards
+        if getattr(self, 'pool', None) is None:
+            self.pool = SlabPool()
+
+        # Run the batch engine with the settings of the GUI
+        scan = Scan(self.log, self.fnames, self.pix, (self.nx, self.ny))
+        sigma = int(self.sigmaSpinbox.get()) if int(self.cb2var.get()) == 1 else None
+        try:
+            batch = DeconvolutionBatch(scan, self.dec_dir, self.low, self.hi, deconvolution=int(self.cb1var.get()) == 1, \
+                                       sigma=sigma, noise_level=float(self.noiseSpinbox.get()), \
+                                       scan_psf=int(self.cb3var.get()) == 1, \
+                                       backend='gpu' if 'pycuda.autoinit' in sys.modules else 'cpu', \
+                                       fmt=self.formatvar.get(), float32=int(self.cb4var.get()) == 1, \
+                                       compress=int(self.compressSpinbox.get()), io_workers=self.ioWorkers(), pool=self.pool, \
+                                       reconstruct=int(self.cb5var.get()) == 1)
+        except ValueError as e:
+            # Slices outside the scan
+            winsound.PlaySound("*", winsound.SND_ALIAS)
+            self.messageLab.config(bg="white")
+            self.stringvar.set(" ")
+            self.stringvar.set(str(e))
+            self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
+            return
+
+        # The batch runs on the worker, Cancel stops it at the end of the current slab
+        cancel = threading.Event()
+        if self.runTask(lambda: batch.run(progress=self.batchProgress, cancel=cancel), self.batchDone):
+            self.cancel = cancel
+
+    def batchDone(self, result):
+
+        self.stringvar.set(" ")
+        self.stringvar.set("Done!")
 
     def run_dec_series(self):
 
@@ -1088,17 +1379,11 @@ class deconvolution():
 
                             self.dec_series()
 
-                            self.stringvar.set(" ")
-                            self.stringvar.set("Done!")
-
                     else:
                         os.makedirs(self.dec_dir)
 
                         self.dec_series()
 
-                        self.stringvar.set(" ")
-                        self.stringvar.set("Done!")
-
             else:
                 winsound.PlaySound("*", winsound.SND_ALIAS)
                 self.messageLab.config(bg="white")
@@ -1121,27 +1406,37 @@ class deconvolution():
             self.messageLab.after(700, lambda: self.messageLab.config(bg=self.bgcol))
 
         else:
-            self.sinom = remove_blob_sino_wavelet(self.sino, sigma=int(self.sigmaSpinbox.get()))
+            settings = self.previewSettings()
 
-            self.slicenoBlobs = self.runFBP(self.sinom)
-            #self.slicenoBlobs = self.slicenoBlobs*np.mean(self.slice)
+            def work():
+                self.sinom = remove_blob_sino_wavelet(self.sino, sigma=settings['sigma'])
 
-            self.ax4.imshow(self.slicenoBlobs, cmap='gray_r')
-            self.fig4.canvas.draw()
+                return self.runFBP(self.sinom, settings)
 
-            # Update spinboxes
-            self.minCblobSpinbox['from_'] = min( int(2*np.min(self.slicenoBlobs)), int(0.5*np.min(self.slicenoBlobs)))
-            self.maxCblobSpinbox['from_'] = min( int(2*np.min(self.slicenoBlobs)), int(0.5*np.min(self.slicenoBlobs)))
-            self.minCblobSpinbox['to_'] = max(int(2*np.max(self.slicenoBlobs)), int(0.5*np.max(self.slicenoBlobs)))
-            self.maxCblobSpinbox['to_'] = max(int(2*np.max(self.slicenoBlobs)), int(0.5*np.max(self.slicenoBlobs)))
+            self.runTask(work, self.showBlobSlice)
 
-            self.minCblobSpinbox['increment'] = (np.max(self.slicenoBlobs)-np.min(self.slicenoBlobs))/255
-            self.maxCblobSpinbox['increment'] = (np.max(self.slicenoBlobs)-np.min(self.slicenoBlobs))/255
+    def showBlobSlice(self, slic):
 
-            self.minCblobSpinbox.delete(0,5) # delete all characters that were pre-populated
-            self.minCblobSpinbox.insert(0,int(np.min(self.slicenoBlobs))) # Insert starting point
-            self.maxCblobSpinbox.delete(0,5) # delete all characters that were pre-populated
-            self.maxCblobSpinbox.insert(0,int(np.max(self.slicenoBlobs))) # Insert starting point
+        self.slicenoBlobs = slic
+        self.showCenter()
+        #self.slicenoBlobs = self.slicenoBlobs*np.mean(self.slice)
+
+        self.ax4.imshow(self.slicenoBlobs, cmap='gray_r')
+        self.fig4.canvas.draw()
+
+        # Update spinboxes
+        self.minCblobSpinbox['from_'] = min( int(2*np.min(self.slicenoBlobs)), int(0.5*np.min(self.slicenoBlobs)))
+        self.maxCblobSpinbox['from_'] = min( int(2*np.min(self.slicenoBlobs)), int(0.5*np.min(self.slicenoBlobs)))
+        self.minCblobSpinbox['to_'] = max(int(2*np.max(self.slicenoBlobs)), int(0.5*np.max(self.slicenoBlobs)))
+        self.maxCblobSpinbox['to_'] = max(int(2*np.max(self.slicenoBlobs)), int(0.5*np.max(self.slicenoBlobs)))
+
+        self.minCblobSpinbox['increment'] = (np.max(self.slicenoBlobs)-np.min(self.slicenoBlobs))/255
+        self.maxCblobSpinbox['increment'] = (np.max(self.slicenoBlobs)-np.min(self.slicenoBlobs))/255
+
+        self.minCblobSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.minCblobSpinbox.insert(0,int(np.min(self.slicenoBlobs))) # Insert starting point
+        self.maxCblobSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.maxCblobSpinbox.insert(0,int(np.max(self.slicenoBlobs))) # Insert starting point
 
 
     def dec_blob(self):
@@ -1172,36 +1467,45 @@ class deconvolution():
 
             else:
 
-                # Run deconvolution
-                self.decsino = self.runDec(self.sino)
+                settings = self.previewSettings()
+
+                def work():
+                    # Run deconvolution
+                    self.decsino = self.runDec(self.sino, settings['noise'])
 
-                # Run blob removal first
-                self.sinom = remove_blob_sino_wavelet(self.decsino, sigma=int(self.sigmaSpinbox.get()))
+                    # Run blob removal first
+                    self.sinom = remove_blob_sino_wavelet(self.decsino, sigma=settings['sigma'])
 
-                # Run FBP reconstruction
-                self.decslicem = self.runFBP(self.sinom)
+                    # Run FBP reconstruction
+                    return self.runFBP(self.sinom, settings)
 
-                #self.decslicem = self.decslicem*np.mean(self.slice)
+                self.runTask(work, self.showDecBlobSlice)
 
-                # Display the reconstructed slice
-                self.ax5.imshow(self.decslicem, cmap='gray_r')
-                self.fig5.canvas.draw()
+    def showDecBlobSlice(self, slic):
 
-                # Update spinboxes
-                self.minCdecblobSpinbox['from_'] = min( int(2*np.min(self.decslicem)), int(0.5*np.min(self.decslicem)))
-                self.maxCdecblobSpinbox['from_'] = min( int(2*np.min(self.decslicem)), int(0.5*np.min(self.decslicem)))
-                self.minCdecblobSpinbox['to_'] = max(int(2*np.max(self.decslicem)), int(0.5*np.max(self.decslicem)))
-                self.maxCdecblobSpinbox['to_'] = max(int(2*np.max(self.decslicem)), int(0.5*np.max(self.decslicem)))
+        self.decslicem = slic
+        self.showCenter()
 
-                self.minCdecblobSpinbox['increment'] = (np.max(self.decslicem)-np.min(self.decslicem))/255
-                self.maxCdecblobSpinbox['increment'] = (np.max(self.decslicem)-np.min(self.decslicem))/255
+        #self.decslicem = self.decslicem*np.mean(self.slice)
 
-                self.minCdecblobSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.minCdecblobSpinbox.insert(0,int(np.min(self.decslicem))) # Insert starting point
-                self.maxCdecblobSpinbox.delete(0,5) # delete all characters that were pre-populated
-                self.maxCdecblobSpinbox.insert(0,int(np.max(self.decslicem))) # Insert starting point
+        # Display the reconstructed slice
+        self.ax5.imshow(self.decslicem, cmap='gray_r')
+        self.fig5.canvas.draw()
 
+        # Update spinboxes
+        self.minCdecblobSpinbox['from_'] = min( int(2*np.min(self.decslicem)), int(0.5*np.min(self.decslicem)))
+        self.maxCdecblobSpinbox['from_'] = min( int(2*np.min(self.decslicem)), int(0.5*np.min(self.decslicem)))
+        self.minCdecblobSpinbox['to_'] = max(int(2*np.max(self.decslicem)), int(0.5*np.max(self.decslicem)))
+        self.maxCdecblobSpinbox['to_'] = max(int(2*np.max(self.decslicem)), int(0.5*np.max(self.decslicem)))
 
+        self.minCdecblobSpinbox['increment'] = (np.max(self.decslicem)-np.min(self.decslicem))/255
+        self.maxCdecblobSpinbox['increment'] = (np.max(self.decslicem)-np.min(self.decslicem))/255
 
+        self.minCdecblobSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.minCdecblobSpinbox.insert(0,int(np.min(self.decslicem))) # Insert starting point
+        self.maxCdecblobSpinbox.delete(0,5) # delete all characters that were pre-populated
+        self.maxCdecblobSpinbox.insert(0,int(np.max(self.decslicem))) # Insert starting point
 
-dec = deconvolution()
+if __name__ == '__main__':
+    # The guard keeps the processes of the batch pool from opening the GUI
+    dec = deconvolution()
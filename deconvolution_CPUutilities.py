@@ -3,7 +3,17 @@
 
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d
-from common_utilities import corrCoeff, sino_centering, psf1d_data
+from common_utilities import corrCoeff, sino_centering, psf1d_data, deconvolution_filter, \
+                             half_deconvolution_filter, vertical_power_spectrum
+
+# Real-input FFTs. scipy.fft keeps single precision inputs in single precision
+# and can split a batch of transforms over several threads
+try:
+    from scipy.fft import rfft2, irfft2
+    SCIPY_FFT = True
+except ImportError:
+    from numpy.fft import rfft2, irfft2
+    SCIPY_FFT = False
 
 def corrCoeff(arr1, arr2):
 
@@ -33,53 +43,97 @@ def psf1d_data(mask, shape):
     return np.outer(gaussian_filter1d(mask.astype('float32'), 100), np.ones(shape[1]))
 
 
-def runDeconvolutionCPU(sinogram, pixel_size, noise_level=0.05):
+def estimateFilterCPU(sinograms, pixel_size, noise_level=0.05, fast=True):
+
+    ''' Estimate the deconvolution transfer function once for the whole scan. 
+    The power spectrum is averaged over a few sample sinograms of the scan, and 
+    the result can be passed to runDeconvolutionCPU for every slice.
+    With fast=True the filter is returned in the half-spectrum, single precision
+    form used by the fast path of runDeconvolutionCPU'''
+
+    vertps = 0.
+    for sinogram in sinograms:
+        # Same mean offset as in runDeconvolutionCPU, without modifying the sample
+        if fast is True:
+            fsino = rfft2(np.asarray(sinogram + np.mean(sinogram), dtype='float32'))
+            vertps = vertps + vertical_power_spectrum(fsino, sinogram.shape[1])
+        else:
+            fsino = np.fft.fft2(sinogram + np.mean(sinogram))
+            vertps = vertps + np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
+
+    if fast is True:
+        return half_deconvolution_filter(vertps/len(sinograms), sinograms[0].shape, pixel_size, noise_level)
+
+    return deconvolution_filter(vertps/len(sinograms), sinograms[0].shape, pixel_size, noise_level)
+
+def runDeconvolutionCPU(sinogram, pixel_size, noise_level=0.05, transfer=None, fast=True):
+
+    ''' Deconvolution of a sinogram (pixels, angles). The fast path works in single 
+    precision with real-input FFTs. fast=False runs the original complex128 
+    computation. A transfer function from estimateFilterCPU (with the same 
+    value of fast) skips the estimation of the PSF from this sinogram'''
 
     # Subtract the mean from the sinogram
     sinogram -= -np.mean(sinogram)
 
+    if fast is True:
+        # Calculate the FT of the sinogram. Only the n2//2+1 non-redundant columns are computed
+        fsino = rfft2(np.asarray(sinogram, dtype='float32'))
+
+        if transfer is None:
+            # Get the power spectrum in the vertical direction (pixel axis)
+            vertps = vertical_power_spectrum(fsino, sinogram.shape[1])
+
+            # Roll-off filter combined to the Wiener filter of the PSF estimated from this sinogram
+            transfer = half_deconvolution_filter(vertps, sinogram.shape, pixel_size, noise_level)
+
+        fsino *= transfer
+
+        return irfft2(fsino, s=sinogram.shape).astype('float32', copy=False)
+
     # Calculate the FT of the sinogram 
     fsino = np.fft.fft2(sinogram)
-    #fsino = fft2_gpu(sino)
-    fsinot = np.fft.fft2(sinogram)
 
-    # Get the power spectrum in the vertical direction (pixel axis)
-    vertps = np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
+    if transfer is None:
+        # Get the power spectrum in the vertical direction (pixel axis)
+        vertps = np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
 
-    # Get the baseline (first 200 pixels) corresponding to noise
-    baseline = np.mean(vertps[:200])
+        # Roll-off filter combined to the Wiener filter of the PSF estimated from this sinogram
+        transfer = deconvolution_filter(vertps, sinogram.shape, pixel_size, noise_level)
 
-    # Mask out everything that is smaller than the baseline + 50% after Gaussian smoothing with sigma=3
-    mask = gaussian_filter1d(vertps,3) > 1.4*baseline 
+    fsino_dec = transfer*fsino
 
-    # Generate psf from data
-    psf_d = np.fft.fftshift(psf1d_data(mask, sinogram.shape))
+    sino_dec = np.real(np.fft.ifft2(fsino_dec) )
 
-    # Define the angular range in rad (360 deg rotation)        
-    Phi = np.linspace(-sinogram.shape[1]/(4*np.pi), sinogram.shape[1]/(4*np.pi), sinogram.shape[1], True) 
+    return sino_dec
 
-    # Define the transverse horizontal coordinate in Fourier space       
-    Rx = np.linspace(-0.5/pixel_size, 0.5/pixel_size, sinogram.shape[0], True)
+def runDeconvolutionCPUBatch(sinograms, pixel_size, noise_level=0.05, transfer=None, workers=-1):
 
-    line = np.outer(1.0/Rx, Phi)
+    ''' Deconvolution of a stack of sinograms (slices, pixels, angles), equivalent to
+    the fast path of runDeconvolutionCPU applied to each slice. All the slices are
+    transformed by a single FFT call batched over the first axis, and the filters
+    are broadcast over the stack. A transfer function from estimateFilterCPU is 
+    applied to all the slices, otherwise the PSF is estimated slice by slice.
+    workers is the number of threads used by scipy.fft (-1 = all the cores)'''
 
-    # Define the roll-off filter
-    Wr = np.zeros_like(fsino)
-    w = 0.3
-    for i in range(fsino.shape[0]):
-        for j in range(fsino.shape[1]):
-      
-            if line[i,j] <= 0.:
-                Wr[i,j] = 1.0
-            elif line[i,j] > w:
-                Wr[i,j] = 0.000001
-            else:
-                Wr[i,j] = np.cos( (np.pi/2)*np.abs(line[i,j])/w)
+    nslices, n1, n2 = sinograms.shape
+    kwargs = {'workers': workers} if SCIPY_FFT is True else {}
 
-    # Roll-off filter combined to Wiener filter
-    fsino_dec = Wr*fsino*np.conj(psf_d)/(psf_d*np.conj(psf_d)+noise_level)
+    # Same mean offset as in runDeconvolutionCPU, slice by slice (the input is not modified)
+    sinograms = np.asarray(sinograms, dtype='float32')
+    sinograms = sinograms + np.mean(sinograms, axis=(1,2), keepdims=True)
 
-    sino_dec = np.real(np.fft.ifft2(fsino_dec) )
+    # Calculate the FT of all the sinograms
+    fsino = rfft2(sinograms, axes=(1,2), **kwargs)
+    del sinograms
 
-    return sino_dec
+    if transfer is None:
+        # Get the power spectra in the vertical direction (one for each slice)
+        vertps = vertical_power_spectrum(fsino, n2)
+
+        # Roll-off filter combined to the Wiener filter of the PSF of each slice
+        transfer = half_deconvolution_filter(vertps, (n1, n2), pixel_size, noise_level)
+
+    fsino *= transfer
 
+    return irfft2(fsino, s=(n1, n2), axes=(1,2), **kwargs).astype('float32', copy=False)
@@ -5,8 +5,7 @@ import numpy as np
 import pycuda.autoinit
 import pycuda.gpuarray as gpuarray
 import skcuda.fft as cu_fft
-from scipy.ndimage.filters import gaussian_filter1d
-from common_utilities import corrCoeff, sino_centering, psf1d_data
+from common_utilities import corrCoeff, sino_centering, deconvolution_filter
 
 
 def fft2_gpu(x, fftshift=False):
@@ -85,7 +84,21 @@ def ifft2_gpu(y, fftshift=False):
     
     return xout
 
-def runDeconvolutionGPU(sinogram, pixel_size, noise_level=0.05):
+def estimateFilterGPU(sinograms, pixel_size, noise_level=0.05):
+
+    ''' Estimate the deconvolution transfer function once for the whole scan. 
+    The power spectrum is averaged over a few sample sinograms of the scan, and 
+    the result can be passed to runDeconvolutionGPU for every slice'''
+
+    vertps = 0.
+    for sinogram in sinograms:
+        # Same mean offset as in runDeconvolutionGPU, without modifying the sample
+        fsino = fft2_gpu(sinogram + np.mean(sinogram))
+        vertps = vertps + np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
+
+    return deconvolution_filter(vertps/len(sinograms), sinograms[0].shape, pixel_size, noise_level)
+
+def runDeconvolutionGPU(sinogram, pixel_size, noise_level=0.05, transfer=None):
 
     # Subtract the mean from the sinogram
     sinogram -= -np.mean(sinogram)
@@ -93,48 +106,17 @@ def runDeconvolutionGPU(sinogram, pixel_size, noise_level=0.05):
     # Calculate the FT of the sinogram 
     #fsino = np.fft.fft2(sino)
     fsino = fft2_gpu(sinogram)
-    fsinot = np.fft.fft2(sinogram)
-
-    # Get the power spectrum in the vertical direction (pixel axis)
-    vertps = np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
-
-    # Get the baseline (first 200 pixels) corresponding to noise
-    baseline = np.mean(vertps[:200])
-
-    # Mask out everything that is smaller than the baseline + 50% after Gaussian smoothing with sigma=3
-    mask = gaussian_filter1d(vertps,3) > 1.4*baseline 
 
-    # Generate psf from data
-    psf_d = np.fft.fftshift(psf1d_data(mask, sinogram.shape))
+    if transfer is None:
+        # Get the power spectrum in the vertical direction (pixel axis)
+        vertps = np.mean(np.abs(np.fft.fftshift(fsino)), axis=1)
 
-    # Define the angular range in rad (360 deg rotation)        
-    Phi = np.linspace(-sinogram.shape[1]/(4*np.pi), sinogram.shape[1]/(4*np.pi), sinogram.shape[1], True) 
+        # Roll-off filter combined to the Wiener filter of the PSF estimated from this sinogram
+        transfer = deconvolution_filter(vertps, sinogram.shape, pixel_size, noise_level)
 
-    # Define the transverse horizontal coordinate in Fourier space       
-    Rx = np.linspace(-0.5/pixel_size, 0.5/pixel_size, sinogram.shape[0], True)
-
-    line = np.outer(1.0/Rx, Phi)
-
-    # Define the roll-off filter
-    Wr = np.zeros_like(fsino)
-    w = 0.3
-    for i in range(fsino.shape[0]):
-        for j in range(fsino.shape[1]):
-      
-            if line[i,j] <= 0.:
-                Wr[i,j] = 1.0
-            elif line[i,j] > w:
-                Wr[i,j] = 0.000001
-            else:
-                Wr[i,j] = np.cos( (np.pi/2)*np.abs(line[i,j])/w)
-
-    # Roll-off filter combined to Wiener filter
-    fsino_dec = Wr*fsino*np.conj(psf_d)/(psf_d*np.conj(psf_d)+noise_level)
+    fsino_dec = transfer*fsino
 
     #sino_dec = np.real(np.fft.ifft2(fsinot) )
     sino_dec = np.real(ifft2_gpu(fsino_dec) )
 
     return sino_dec
-
-
-
@@ -0,0 +1,501 @@
+''' This file contains the batch processing of a scan (deconvolution and blob
+    removal of a range of slices), independent of the GUI. It can be used as
+    a module or from the command line:
+
+    python deconvolution_batch.py <scan directory> --low 0 --hi 400 --sigma 5'''
+
+import argparse
+import glob
+import os
+import sys
+from shutil import copyfile
+import numpy as np
+
+try:
+    from skimage.external import tifffile as tif
+except ImportError:
+    import tifffile as tif
+
+from common_utilities import sino_center, fit_rotation_axis
+from io_utilities import read_sinogram_rows, projection_store, store_sinograms, \
+                         volume_writer, VOLUME_FORMATS
+from batch_utilities import SlabPool, Writer, Journal, reconstruct_stored
+from fbp_CPUutilities import iradon_cpu
+
+
+# Deconvolution backends
+BACKENDS = ('auto', 'cpu', 'gpu')
+
+def gpu_available():
+
+    ''' True if the GPU deconvolution can be used (pycuda and scikit-cuda installed)'''
+
+    try:
+        import deconvolution_GPUutilities
+        return True
+    except ImportError:
+        return False
+
+def resolve_backend(backend='auto'):
+
+    ''' 'cpu' or 'gpu'. 'auto' selects the GPU when it is available'''
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend "+str(backend))
+    if backend == 'auto':
+        return 'gpu' if gpu_available() else 'cpu'
+    if backend == 'gpu' and not gpu_available():
+        raise ImportError("The GPU backend requires pycuda and scikit-cuda")
+
+    return backend
+
+def astra_available():
+
+    ''' True if the reconstructions can use the astra toolbox. The toolbox is imported 
+    only when needed, so that the processes of the batch pool do not load it'''
+
+    try:
+        import astra_GPUutilities
+        return True
+    except ImportError:
+        return False
+
+def read_log(fname):
+
+    ''' Pixel size and full rotation flag (True for 360 degree scans) from the log file of a scan'''
+
+    with open(fname, 'r') as f:
+        logtext = f.read().split('\n')
+
+    return float(logtext[5].split('=')[-1]), logtext[14].split('=')[-1].strip() != 'NO'
+
+class Scan(object):
+
+    ''' Files and geometry of a scan: the log file, the list of projections, the
+    pixel size and the (rows, pixels) shape of the projections'''
+
+    def __init__(self, log, fnames, pixel_size, shape):
+
+        self.log = log
+        self.fnames = list(fnames)
+        self.pixel_size = pixel_size
+        self.shape = tuple(shape)
+
+    @property
+    def nangles(self):
+        return len(self.fnames)
+
+def load_scan(directory):
+
+    ''' Scan found in directory (log file and projections *_0*tif). 360 degree
+    scans only, a ValueError is raised otherwise'''
+
+    logs = glob.glob(os.path.join(directory, '*log'))
+    if len(logs) == 0:
+        raise ValueError("No valid log file present in "+directory)
+
+    pixel_size, fullrot = read_log(logs[0])
+    if fullrot is False:
+        raise ValueError("The scan is 180 degree only. Can't correct this scan.")
+
+    fnames = sorted(glob.glob(os.path.join(directory, '*_0*tif')))
+    if len(fnames) == 0:
+        raise ValueError("No projections present in "+directory)
+
+    return Scan(logs[0], fnames, pixel_size, tif.imread(fnames[0]).shape)
+
+def deconvolve_block(sinograms, pixel_size, noise_level=0.05, transfer=None, backend='cpu'):
+
+    ''' Deconvolution of a block of sinograms (slices, pixels, angles)'''
+
+    if backend == 'gpu':
+        from deconvolution_GPUutilities import runDeconvolutionGPU
+        return np.array([runDeconvolutionGPU(sinog, pixel_size, noise_level=noise_level, transfer=transfer) \
+                         for sinog in sinograms], dtype='float32')
+
+    from deconvolution_CPUutilities import runDeconvolutionCPUBatch
+    return runDeconvolutionCPUBatch(sinograms, pixel_size, noise_level=noise_level, transfer=transfer)
+
+def estimate_filter(fnames, low, hi, pixel_size, noise_level=0.05, backend='cpu', nsamples=5, \
+                    workers=None, callback=None):
+
+    ''' Estimate the deconvolution filter once for the slices in [low, hi),
+    from nsamples sinograms evenly spaced in the range'''
+
+    rows = np.unique(np.linspace(low, hi-1, nsamples).astype('int'))
+
+    # Read all the sample sinograms in a single pass over the projections
+    samples = list(read_sinogram_rows(fnames, rows, callback=callback, workers=workers))
+
+    if backend == 'gpu':
+        from deconvolution_GPUutilities import estimateFilterGPU
+        return estimateFilterGPU(samples, pixel_size, noise_level=noise_level)
+
+    from deconvolution_CPUutilities import estimateFilterCPU
+    return estimateFilterCPU(samples, pixel_size, noise_level=noise_level)
+
+# Rotation axis models of the scans, keyed by projection files and sampling
+_axis_cache = {}
+
+def estimate_rotation_axis(fnames, nrows, nsamples=8, fullrot=True, xshifts=None, yshifts=None, \
+                           workers=None, callback=None):
+
+    ''' RotationAxis of a scan of nrows rows, fitted to the centering of nsamples 
+    sinograms spread over the rows. The sample sinograms are read in a single pass
+    over the projections, with the xy drift corrections (xshifts, yshifts, as in 
+    read_sinogram) when given. The model is cached for the scan'''
+
+    key = (tuple(fnames), nrows, nsamples, fullrot, \
+           None if xshifts is None else tuple(xshifts), None if yshifts is None else tuple(yshifts))
+    try:
+        return _axis_cache[key]
+    except KeyError:
+        pass
+
+    # Rows spread over the scan, away from the top and bottom edges
+    rows = np.unique(np.linspace(0.1*nrows, 0.9*nrows, nsamples).astype('int'))
+
+    samples = read_sinogram_rows(fnames, rows, callback=callback, workers=workers, \
+                                 xshifts=xshifts, yshifts=yshifts)
+
+    centers = [sino_center(sinogram, fullrot) for sinogram in samples]
+    axis = fit_rotation_axis(rows, [c[0] for c in centers], [c[1] for c in centers])
+    _axis_cache[key] = axis
+
+    return axis
+
+def clear_axis_cache():
+
+    ''' Release the cached rotation axis models (e.g. when a new scan is loaded)'''
+
+    _axis_cache.clear()
+
+def reconstruct_slice(sinogram, theta, output_size, shift=0.0, backend='cpu'):
+
+    ''' FBP reconstruction of a sinogram (pixels, angles) centred by shift, with the 
+    astra toolbox when installed (integer shift), otherwise with the Numpy FBP'''
+
+    if astra_available():
+        from astra_GPUutilities import iradon_astra
+        return iradon_astra(np.roll(sinogram, int(np.round(shift)), axis=0), theta, output_size, \
+                            gpu=backend == 'gpu')
+
+    return iradon_cpu(sinogram, theta, output_size, shift=shift)
+
+class BatchCancelled(Exception):
+
+    ''' Raised by DeconvolutionBatch.run when the batch is cancelled'''
+
+class DeconvolutionBatch(object):
+
+    ''' Deconvolution and/or blob removal of the slices [low, hi) of a scan, saved as
+    new projections in out_dir. Blob removal is run when sigma is given. The slices
+    are processed in slabs of nblock sinograms on a SlabPool (a new one unless pool
+    is given), and stored in an intermediate memory map with a journal, so that an
+    interrupted batch is resumed by a new run with the same parameters. With 
+    center=True the rotation axis of the scan is estimated and saved in the 
+    metadata of the output. With reconstruct=True the processed slices are also 
+    reconstructed (output_size pixels wide, default the detector width) and saved in
+    out_dir/reconstruction in the output format. The output is deflate-compressed
+    at level compress (0 = uncompressed)'''
+
+    def __init__(self, scan, out_dir, low, hi, deconvolution=True, sigma=None, noise_level=0.05, \
+                 scan_psf=False, backend='auto', fmt='tiff', float32=False, io_workers=None, \
+                 nblock=16, pool=None, center=False, reconstruct=False, output_size=None, compress=0):
+
+        if not 0 <= low < hi <= scan.shape[0]:
+            raise ValueError("Slices [%d, %d) outside the %d rows of the scan" % (low, hi, scan.shape[0]))
+
+        self.scan = scan
+        self.out_dir = out_dir
+        self.low, self.hi = low, hi
+        self.deconvolution = deconvolution
+        self.sigma = sigma
+        self.noise_level = noise_level
+        self.scan_psf = scan_psf
+        self.backend = resolve_backend(backend)
+        self.fmt = fmt
+        self.float32 = float32
+        self.compress = compress
+        self.io_workers = io_workers
+        self.nblock = nblock
+        self.pool = pool
+        self.center = center
+        self.reconstruct = reconstruct
+        self.output_size = output_size or scan.shape[1]
+
+    def run(self, progress=None, idle=None, cancel=None):
+
+        ''' Run the batch. progress(message, fraction) reports the progress of each
+        stage (fraction is None when unknown), idle() is called regularly while 
+        waiting (e.g. to keep a GUI alive). When the threading.Event cancel is set
+        the batch stops at the end of the current slab and raises BatchCancelled: 
+        the slabs already stored are kept and a new run resumes from them'''
+
+        self.progress = progress or (lambda message, fraction: None)
+        self.idle = idle
+        self.cancel = cancel
+
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        # Copy the log file across
+        copyfile(self.scan.log, os.path.join(self.out_dir, os.path.basename(self.scan.log)))
+
+        # Rotation axis of the scan. The projections are not centred, the model is recorded
+        # and used by the reconstruction
+        self.axis = None
+        if self.center or self.reconstruct:
+            self.progress("Estimating the rotation axis...", None)
+            self.axis = estimate_rotation_axis(self.scan.fnames, self.scan.shape[0], workers=self.io_workers, \
+                                               callback=self._keep_alive)
+            self._check_cancel()
+
+        own_pool = self.pool is None
+        if own_pool:
+            self.pool = SlabPool()
+        try:
+            self.process()
+            if self.reconstruct:
+                self._check_cancel()
+                self.reconstruct_slices()
+        finally:
+            if own_pool:
+                self.pool.close()
+                self.pool = None
+
+        self._check_cancel()
+        self.write()
+
+    def _check_cancel(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise BatchCancelled("Batch cancelled")
+
+    def _keep_alive(self, i):
+
+        # Read callback keeping the caller responsive during long reads
+        if self.idle is not None and i % 50 == 0:
+            self.idle()
+
+    def process(self):
+
+        ''' Process the slices into the intermediate memory map'''
+
+        npixels = self.scan.shape[1]
+        nslices = self.hi-self.low
+        self.storename = os.path.join(self.out_dir, 'sino_memmap')
+
+        # Journal of the slabs already processed. A rerun with the same parameters after an
+        # interruption resumes from the memory map left behind, skipping the finished slabs
+        self.journal = Journal(self.storename+'.json', \
+                               {'fnames': self.scan.nangles, 'first': os.path.basename(self.scan.fnames[0]), \
+                                'low': self.low, 'hi': self.hi, 'shape': [npixels, self.scan.nangles], \
+                                'nblock': self.nblock, 'deconvolution': int(self.deconvolution), \
+                                'blob_removal': int(self.sigma is not None), 'scan_psf': int(self.scan_psf), \
+                                'noise_level': float(self.noise_level), 'sigma': self.sigma, \
+                                'pixel_size': float(self.scan.pixel_size)})
+
+        # create memmap (angles, slices, pixels), so that each new projection is contiguous
+        mode = 'w+'
+        if self.journal.resumed:
+            if os.path.exists(self.storename) and \
+               os.path.getsize(self.storename) == 4*nslices*npixels*self.scan.nangles:
+                mode = 'r+'
+            else:
+                self.journal.reset()
+        self.store = projection_store(self.storename, nslices, npixels, self.scan.nangles, mode=mode)
+
+        # Estimate the PSF for the whole scan if required, otherwise it is estimated slice by slice
+        self.transfer = None
+        if self.deconvolution and self.scan_psf:
+            self.progress("Estimating the PSF of the scan...", None)
+            self.transfer = estimate_filter(self.scan.fnames, self.low, self.hi, self.scan.pixel_size, \
+                                            self.noise_level, self.backend, workers=self.io_workers, \
+                                            callback=self._keep_alive)
+            self._check_cancel()
+
+        # Options of the processing of each slice. The GPU deconvolution runs in this
+        # process, everything else on the pool of processes
+        params, prepare = {}, None
+        if self.deconvolution:
+            if self.backend == 'gpu':
+                prepare = lambda block: deconvolve_block(block, self.scan.pixel_size, self.noise_level, \
+                                                         self.transfer, 'gpu')
+            else:
+                params.update(pixel_size=self.scan.pixel_size, noise_level=self.noise_level, transfer=self.transfer)
+        if self.sigma is not None:
+            params['sigma'] = self.sigma
+
+        # Process the slices in slabs of nblock sinograms (slices, pixels, angles), as a
+        # pipeline: slab n+1 is read while slab n is processed and slab n-1 is stored.
+        # The bounded queues between the stages keep the memory use independent of the scan size
+        self.vmin, self.vmax = self.journal.range()
+        with Writer(self._store, idle=self.idle) as writer:
+            for k0, k1, block in self.pool.slabs(self.scan.fnames, self.low, self.hi, (npixels, self.scan.nangles), \
+                                                 self.nblock, prepare=prepare, idle=self.idle, \
+                                                 workers=self.io_workers, skip=self.journal.done, **params):
+
+                # Populate the memory map with the processed sino data (on the writer thread)
+                writer.put(k0, k1, block)
+                self.progress("Saving deconvolved sinograms", float(k1-self.low)/nslices)
+
+                # Stop at the slab boundary: the slabs queued are still stored and journaled
+                self._check_cancel()
+
+    def _store(self, k0, k1, block):
+
+        # Store the processed sinograms of the rows [k0, k1) into the memory map, update
+        # the range of the values stored so far and record the slab in the journal
+        store_sinograms(self.store, k0-self.low, block)
+        bmin, bmax = float(np.min(block)), float(np.max(block))
+        self.vmin = min(self.vmin, bmin)
+        self.vmax = max(self.vmax, bmax)
+
+        # The slab is recorded only once its data are on disk
+        self.store.flush()
+        self.journal.record(k0, k1, bmin, bmax)
+
+    def reconstruct_slices(self):
+
+        ''' Reconstruct the processed slices from the intermediate memory map into
+        out_dir/reconstruction, as a volume (slices, output_size, output_size) in the
+        output format. With the GPU backend and the astra toolbox the slices are 
+        reconstructed in this process, otherwise by the Numpy FBP on the processes
+        of the pool, one slice per process at a time'''
+
+        nslices = self.hi-self.low
+        theta = np.linspace(0, 360, self.scan.nangles)
+        shifts = [self.axis.shift(k) for k in range(self.low, self.hi)]
+
+        if self.backend == 'gpu' and astra_available():
+            recs = (reconstruct_slice(np.array(self.store[:,i,:].T), theta, self.output_size, shifts[i], 'gpu') \
+                    for i in range(nslices))
+        else:
+            recs = self.pool.map(reconstruct_stored, [(self.storename, self.store.shape, i, theta, self.output_size, \
+                                                       shifts[i]) for i in range(nslices)], idle=self.idle)
+
+        recdir = os.path.join(self.out_dir, 'reconstruction')
+        if not os.path.exists(recdir):
+            os.makedirs(recdir)
+        base = os.path.join(recdir, os.path.basename(self.scan.log)[:-4]+'_rec')
+        metadata = {'log': os.path.basename(self.scan.log), 'pixel_size': float(self.scan.pixel_size), \
+                    'lower_slice': self.low, 'upper_slice': self.hi, 'angles': self.scan.nangles, \
+                    'axis_center': self.axis.center, 'axis_tilt': self.axis.tilt}
+
+        try:
+            with volume_writer(self.fmt, base, (nslices, self.output_size, self.output_size), 'float32', \
+                               compress=self.compress, metadata=metadata, workers=self.io_workers) as writer:
+                for i, rec in enumerate(recs):
+                    writer.write_projection(i, np.asarray(rec, dtype='float32'))
+                    self.progress("Reconstructing slices", float(i+1)/nslices)
+                    self._check_cancel()
+        finally:
+            recs.close()
+
+    def write(self):
+
+        ''' Save the new projections from the intermediate memory map, then delete it'''
+
+        nangles = self.scan.nangles
+
+        # Get the range of the processed sinograms (it may be larger than 16-bit). The minimum
+        # is set to zero and the data rescaled to 16-bit if required, one projection at a time
+        vrange = np.abs(self.vmax-self.vmin)
+        scale = 1.0
+        if vrange > 65537.0:
+            scale = vrange/65000
+
+        # Description of the scan stored with the bigtiff and hdf5 outputs
+        metadata = {'log': os.path.basename(self.scan.log), 'pixel_size': float(self.scan.pixel_size), \
+                    'lower_slice': self.low, 'upper_slice': self.hi, 'angles': nangles, \
+                    'deconvolution': int(self.deconvolution), 'blob_removal': int(self.sigma is not None), \
+                    'noise_level': float(self.noise_level), 'sigma': int(self.sigma or 0), \
+                    'offset': 0.0 if self.float32 else float(self.vmin), \
+                    'scale': 1.0 if self.float32 else float(scale)}
+        if self.axis is not None:
+            metadata.update(axis_center=self.axis.center, axis_tilt=self.axis.tilt)
+
+        # Save projections (one contiguous block of the memory map each). The data are
+        # encoded and written on separate threads while the next projections are prepared
+        base = os.path.join(self.out_dir, os.path.basename(self.scan.log)[:-4])
+        with volume_writer(self.fmt, base, self.store.shape, 'float32' if self.float32 else 'uint16', \
+                           compress=self.compress, metadata=metadata, workers=self.io_workers) as writer:
+            for k in range(nangles):
+                if self.float32:
+                    proj = np.array(self.store[k])
+                else:
+                    proj = self.store[k] - np.float32(self.vmin)
+                    if scale != 1.0:
+                        proj /= np.float32(scale)
+                    proj = proj.astype('uint16')
+                writer.write_projection(k, proj)
+
+                self.progress("Saving new projections", float(k+1)/nangles)
+                if self.idle is not None:
+                    self.idle()
+                self._check_cancel()
+
+        # Delete memory map and journal. Until then an interrupted write-out is redone
+        # entirely by the next run, overwriting any partially written output
+        del self.store
+        os.remove(self.storename)
+        self.journal.remove()
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Deconvolution and blob removal of an OPT scan")
+    parser.add_argument('directory', help="scan directory (log file and projections)")
+    parser.add_argument('--low', type=int, default=0, help="lower slice (default 0)")
+    parser.add_argument('--hi', type=int, default=None, help="upper slice, excluded (default all)")
+    parser.add_argument('--output', default=None, help="output directory (default <directory>/deconvolution)")
+    parser.add_argument('--no-deconvolution', action='store_true', help="blob removal only")
+    parser.add_argument('--noise', type=float, default=0.05, help="noise level of the Wiener filter")
+    parser.add_argument('--sigma', type=int, default=None, help="run the blob removal with this sigma")
+    parser.add_argument('--scan-psf', action='store_true', help="estimate the PSF once for the whole scan")
+    parser.add_argument('--backend', choices=BACKENDS, default='auto')
+    parser.add_argument('--format', choices=VOLUME_FORMATS, default='tiff')
+    parser.add_argument('--float32', action='store_true', help="save float32 data instead of 16-bit")
+    parser.add_argument('--compress', type=int, default=0, choices=range(10), \
+                        help="deflate compression level of the output (default 0, uncompressed)")
+    parser.add_argument('--io-workers', type=int, default=None, help="threads reading the projections")
+    parser.add_argument('--processes', type=int, default=None, help="processes of the batch (default all cores)")
+    parser.add_argument('--center', action='store_true', help="record the rotation axis in the output metadata")
+    parser.add_argument('--reconstruct', action='store_true', help="also reconstruct the processed slices")
+    parser.add_argument('--size', type=int, default=None, help="size of the reconstructed slices")
+    args = parser.parse_args(argv)
+
+    if args.no_deconvolution and args.sigma is None:
+        parser.error("nothing to do: select the deconvolution and/or the blob removal (--sigma)")
+
+    try:
+        scan = load_scan(args.directory)
+    except ValueError as e:
+        parser.exit(1, str(e)+'\n')
+
+    hi = scan.shape[0] if args.hi is None else args.hi
+    if not 0 <= args.low < hi <= scan.shape[0]:
+        parser.error("the slices must satisfy 0 <= low < hi <= %d (rows of the scan)" % scan.shape[0])
+    out_dir = args.output or os.path.join(args.directory, 'deconvolution')
+
+    shown = {}
+    def progress(message, fraction):
+        percent = None if fraction is None else int(100*fraction)
+        if message not in shown or shown[message] != percent:
+            shown[message] = percent
+            print(message if percent is None else message+" "+str(percent)+"% complete")
+            sys.stdout.flush()
+
+    pool = SlabPool(args.processes)
+    try:
+        DeconvolutionBatch(scan, out_dir, args.low, hi, deconvolution=not args.no_deconvolution, \
+                           sigma=args.sigma, noise_level=args.noise, scan_psf=args.scan_psf, \
+                           backend=args.backend, fmt=args.format, float32=args.float32, \
+                           compress=args.compress, io_workers=args.io_workers, pool=pool, center=args.center, \
+                           reconstruct=args.reconstruct, output_size=args.size).run(progress=progress)
+    finally:
+        pool.close()
+
+    print("Done!")
+
+if __name__ == '__main__':
+    main()
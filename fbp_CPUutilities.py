@@ -0,0 +1,135 @@
+''' This file contains a filtered back-projection using only Numpy functions,
+    used when the astra toolbox (GPU) is not available. The output is
+    compatible with skimage.transform.iradon (ramp filter, linear interpolation)'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# Cache of the filters and geometries, keyed by (detector width, angles, output size)
+_fbp_cache = {}
+
+def ramp_filter(size):
+
+    ''' Ramp filter for projections zero-padded to size, in the rfft half spectrum.
+    Defined in the spatial domain as in skimage.transform.iradon, to avoid the
+    offset of the discretised frequency ramp'''
+
+    n = np.concatenate((np.arange(1, size/2+1, 2, dtype=int), np.arange(size/2-1, 0, -2, dtype=int)))
+    f = np.zeros(size)
+    f[0] = 0.25
+    f[1::2] = -1/(np.pi*n)**2
+
+    return (2*np.real(np.fft.rfft(f))).astype('float32')
+
+class FBPGeometry(object):
+
+    ''' Filter and back-projection tables of a (detector width, angles, output size)
+    configuration. The filtered projections are kept over margin pixels beyond each
+    edge of the detector, where the ramp filter spreads them. The detector coordinate
+    of the output pixel (i, j) at angle k, as an index in such a filtered projection
+    padded by zeros on each side, is a[k, j] - b[k, i] - shift: only two small
+    tables per angle are stored, and
+    the shift (the one of np.roll(sinogram, shift, axis=0)) is not part of them,
+    so that one geometry serves all the slices of a tilted rotation axis'''
+
+    def __init__(self, npix, theta, output_size):
+
+        self.npix = npix
+        self.nangles = len(theta)
+        self.output_size = output_size
+        self.padded = max(64, int(2**np.ceil(np.log2(2*npix))))
+        self.margin = (self.padded - npix)//2
+        self.filter = ramp_filter(self.padded)
+
+        angles = np.deg2rad(np.asarray(theta, dtype='float64'))
+        coords = np.arange(output_size) - output_size//2
+
+        # Rolling the sinogram by shift moves the detector centre from npix//2 to npix//2+shift,
+        # the shift is subtracted at the back-projection
+        self.a = (np.outer(np.cos(angles), coords) + (npix//2 + self.margin + 1)).astype('float32')
+        self.b = np.outer(np.sin(angles), coords).astype('float32')
+
+        for table in (self.filter, self.a, self.b):
+            table.flags.writeable = False
+
+def fbp_geometry(npix, theta, output_size):
+
+    ''' FBPGeometry of a configuration, computed once and cached'''
+
+    key = (int(npix), tuple(np.round(np.asarray(theta, dtype='float64'), 9)), int(output_size))
+    try:
+        return _fbp_cache[key]
+    except KeyError:
+        pass
+
+    geometry = FBPGeometry(npix, theta, output_size)
+    _fbp_cache[key] = geometry
+
+    return geometry
+
+def clear_fbp_cache():
+
+    ''' Release the cached geometries (e.g. when a new scan is loaded)'''
+
+    _fbp_cache.clear()
+
+def _backproject_rows(filtered, geometry, r0, r1, shift=0.0):
+
+    # Back-projection of the rows [r0, r1) of the output, accumulated over all the angles
+    acc = np.zeros((r1-r0, geometry.output_size), dtype='float32')
+    top = float(geometry.npix + 2*geometry.margin + 1)
+    shift = np.float32(shift)
+
+    for k in range(geometry.nangles):
+        t = (geometry.a[k] - shift)[np.newaxis,:] - geometry.b[k][r0:r1,np.newaxis]
+        # Outside the filtered projection the padding zeros are interpolated
+        np.clip(t, 0, top, out=t)
+        i0 = t.astype('int32')
+        t -= i0
+        row = filtered[k]
+        acc += row[i0] + t*(row[i0+1]-row[i0])
+
+    return acc
+
+def iradon_cpu(sinogram, theta, output_size, shift=0.0, workers=None, block_rows=32):
+
+    ''' Filtered back-projection of a sinogram (pixels, angles) with theta in degrees,
+    equivalent to skimage.transform.iradon(np.roll(sinogram, shift, axis=0), theta,
+    output_size) when the sinogram vanishes at the edges of the detector (np.roll 
+    wraps the edges around). As with the default circle=True of iradon, the pixels
+    outside the circle inscribed in the output are zero. The shift may be fractional. 
+    The output is back-projected in blocks of block_rows rows on workers threads
+    (default all the cores)'''
+
+    npix = sinogram.shape[0]
+    geometry = fbp_geometry(npix, theta, output_size)
+
+    # Ramp filtering of all the projections at once, on zero-padded columns
+    fsino = np.fft.rfft(np.asarray(sinogram, dtype='float32'), n=geometry.padded, axis=0)
+    fsino *= geometry.filter[:,np.newaxis]
+    filtered = np.fft.irfft(fsino, n=geometry.padded, axis=0)
+
+    # One projection per row, from margin pixels before the detector (the end of the
+    # circular convolution) to margin pixels after it, padded by zeros on each side
+    m = geometry.margin
+    padded = np.zeros((geometry.nangles, npix+2*m+3), dtype='float32')
+    padded[:,1:m+1] = filtered[geometry.padded-m:].T
+    padded[:,m+1:npix+2*m+1] = filtered[:npix+m].T
+
+    blocks = [(r0, min(r0+block_rows, output_size)) for r0 in range(0, output_size, block_rows)]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(lambda b: _backproject_rows(padded, geometry, b[0], b[1], shift), blocks))
+    else:
+        parts = [_backproject_rows(padded, geometry, r0, r1, shift) for r0, r1 in blocks]
+
+    rec = np.concatenate(parts, axis=0)*np.pi/(2*geometry.nangles)
+
+    # Zero outside the inscribed circle, as iradon
+    coords = np.arange(output_size) - output_size//2
+    rec[coords[:,np.newaxis]**2 + coords[np.newaxis,:]**2 > (output_size//2)**2] = 0
+
+    return rec
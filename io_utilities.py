@@ -0,0 +1,530 @@
+''' This file contains the functions used to read the projections of a scan
+    and assemble them into sinograms, and to write the processed volume'''
+
+import inspect
+import json
+import queue
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from skimage.external import tifffile as tif
+except ImportError:
+    import tifffile as tif
+
+# h5py is only needed for the HDF5 output
+try:
+    import h5py
+    H5PY = True
+except ImportError:
+    H5PY = False
+
+# Default number of threads reading and decoding the projections concurrently
+IO_WORKERS = 4
+
+
+def tiff_layout(fname):
+
+    ''' Offset, dtype and shape of the pixel data of a single-channel TIFF file stored 
+    uncompressed and contiguous (as written by the acquisition software).
+    Returns None for any other layout, e.g. compressed files'''
+
+    with tif.TiffFile(fname) as tf:
+        page = tf.pages[0]
+        contiguous = page.is_contiguous
+        if not contiguous or len(page.shape) != 2:
+            return None
+
+        # Older tifffile versions return (offset, bytecount), newer ones a boolean
+        if isinstance(contiguous, tuple):
+            offset = contiguous[0]
+        else:
+            offset = page.dataoffsets[0]
+
+        return offset, np.dtype(tf.byteorder+np.dtype(page.dtype).char), page.shape
+
+def read_rows(fname, start, stop):
+
+    ''' Rows [start, stop) of a projection image. For uncompressed files only the bytes
+    of the requested rows are read from disk, otherwise the whole image is decoded'''
+
+    layout = tiff_layout(fname)
+    if layout is None:
+        return tif.imread(fname)[start:stop,:]
+
+    offset, dtype, shape = layout
+    start, stop, _ = slice(start, stop).indices(shape[0])
+    with open(fname, 'rb') as f:
+        f.seek(offset + start*shape[1]*dtype.itemsize)
+        rows = np.fromfile(f, dtype=dtype, count=max(stop-start, 0)*shape[1])
+
+    return rows.reshape(-1, shape[1])
+
+def read_row(fname, k):
+
+    ''' Row k of a projection image. k is taken modulo the number of rows, as
+    for a row of the image rolled along the vertical axis'''
+
+    layout = tiff_layout(fname)
+    if layout is None:
+        proj = tif.imread(fname)
+        return proj[k % proj.shape[0],:]
+
+    k = k % layout[2][0]
+    return read_rows(fname, k, k+1)[0]
+
+def read_row_list(fname, rows):
+
+    ''' Rows of a projection image given as an array of indices, taken modulo the number
+    of rows as in read_row. For uncompressed files only the requested rows are read
+    from disk, with one read per run of consecutive rows'''
+
+    layout = tiff_layout(fname)
+    if layout is None:
+        proj = tif.imread(fname)
+        return proj[np.asarray(rows) % proj.shape[0],:]
+
+    offset, dtype, shape = layout
+    rows = np.asarray(rows) % shape[0]
+    wanted = np.unique(rows)
+    out = np.empty((len(wanted), shape[1]), dtype=dtype)
+
+    # Runs of consecutive rows, as ranges of indices in wanted
+    breaks = np.concatenate(([0], np.flatnonzero(np.diff(wanted) != 1)+1, [len(wanted)]))
+    with open(fname, 'rb') as f:
+        for i0, i1 in zip(breaks[:-1], breaks[1:]):
+            f.seek(offset + int(wanted[i0])*shape[1]*dtype.itemsize)
+            out[i0:i1] = np.fromfile(f, dtype=dtype, count=(i1-i0)*shape[1]).reshape(-1, shape[1])
+
+    return out[np.searchsorted(wanted, rows)]
+
+def imap_ordered(func, items, workers=None, max_in_flight=None):
+
+    ''' Generator of func(item) for the items, evaluated on a pool of threads and 
+    yielded in the order of the items. At most max_in_flight calls (default 
+    2*workers) are pending at any time, so that the results do not pile up in memory. 
+    Exceptions raised by func are raised here'''
+
+    if workers is None:
+        workers = IO_WORKERS
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def read_sinogram(fnames, k, out=None, xshifts=None, yshifts=None, callback=None, workers=None):
+
+    ''' Sinogram (pixels, angles) of row k, reading only that row from each projection.
+    The result is written into out when given. xshifts and yshifts are the drift 
+    corrections of the projections: the row is the same as row k of each projection 
+    rolled by xshifts[i] along the pixels and by yshifts[i] along the rows'''
+
+    if yshifts is None:
+        rows = imap_ordered(lambda j: read_row(j, k), fnames, workers)
+    else:
+        rows = imap_ordered(lambda i: read_row(fnames[i], k-int(yshifts[i])), range(len(fnames)), workers)
+
+    for i,row in enumerate(rows):
+
+        if xshifts is not None:
+            row = np.roll(row, int(xshifts[i]))
+
+        if out is None:
+            out = np.zeros((row.shape[0], len(fnames)))
+        out[:,i] = row
+
+        if callback is not None:
+            callback(i)
+
+    return out
+
+def read_sinogram_slab(fnames, start, stop, out=None, callback=None, workers=None):
+
+    ''' Sinograms of the rows [start, stop) of the projections listed in fnames,
+    as a (rows, pixels, angles) block. Each projection file is read only once
+    for the whole block, using workers threads. callback(i) is called after the 
+    i-th file is read'''
+
+    for i,rows in enumerate(imap_ordered(lambda j: read_rows(j, start, stop), fnames, workers)):
+
+        # Allocate the block once the width of the projections is known
+        if out is None:
+            out = np.empty((stop-start, rows.shape[1], len(fnames)), dtype='float32')
+        out[:,:,i] = rows
+
+        if callback is not None:
+            callback(i)
+
+    return out
+
+def read_sinogram_rows(fnames, rows, callback=None, workers=None, xshifts=None, yshifts=None):
+
+    ''' Sinograms of an arbitrary list of rows, as a (rows, pixels, angles) block.
+    Each projection file is read only once. xshifts and yshifts are the drift 
+    corrections, as in read_sinogram'''
+
+    rows = np.asarray(rows)
+    out = None
+
+    if yshifts is None:
+        projs = imap_ordered(lambda j: read_row_list(j, rows), fnames, workers)
+    else:
+        projs = imap_ordered(lambda i: read_row_list(fnames[i], rows-int(yshifts[i])), range(len(fnames)), workers)
+
+    for i,proj in enumerate(projs):
+
+        if xshifts is not None:
+            proj = np.roll(proj, int(xshifts[i]), axis=1)
+
+        if out is None:
+            out = np.empty((len(rows), proj.shape[1], len(fnames)), dtype='float32')
+        out[:,:,i] = proj
+
+        if callback is not None:
+            callback(i)
+
+    return out
+
+class SinogramCache(object):
+
+    ''' Bounded cache of loaded sinograms, least recently used first out once the
+    arrays take more than maxbytes. Keys are any hashable description of the 
+    sinogram (e.g. scan, row and correction settings). The arrays are copied in 
+    and out, so the callers may modify them in place. Thread safe'''
+
+    def __init__(self, maxbytes=512*1024**2):
+
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+
+        ''' Copy of the cached sinogram, None if it is not in the cache'''
+
+        with self.lock:
+            try:
+                sinogram = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = sinogram
+
+        return sinogram.copy()
+
+    def put(self, key, sinogram):
+
+        ''' Store a copy of the sinogram, evicting the least recently used ones'''
+
+        sinogram = np.array(sinogram)
+        if sinogram.nbytes > self.maxbytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = sinogram
+            self.nbytes += sinogram.nbytes
+
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
+    def clear(self):
+
+        ''' Release all the cached sinograms (e.g. when a new scan is loaded)'''
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+def projection_store(fname, nslices, npixels, nangles, mode='w+'):
+
+    ''' Memory map holding the processed sinograms of a scan in angle-major layout
+    (angles, slices, pixels): each projection is a contiguous block of the file,
+    so the projections are read back with sequential reads. mode='r+' opens an
+    existing store'''
+
+    return np.memmap(fname, dtype='float32', mode=mode, shape=(nangles, nslices, npixels))
+
+def store_sinograms(store, start, block, tile=32):
+
+    ''' Write a block of sinograms (slices, pixels, angles) into the rows starting at
+    start of an angle-major store (angles, slices, pixels). The transpose is done 
+    tile angles at a time, so that each copy works on a block that fits in the cache 
+    and writes contiguous runs of the file'''
+
+    stop = start + block.shape[0]
+    for a0 in range(0, block.shape[2], tile):
+        a1 = min(a0+tile, block.shape[2])
+        store[a0:a1, start:stop, :] = np.transpose(block[:,:,a0:a1], (2,0,1))
+
+def _tiff_compression(compress):
+
+    # Keywords of a deflate compression at level compress. tifffile took compress=level,
+    # then compression=('zlib', level), now compression='zlib' with compressionargs
+    if not compress:
+        return {}
+    if not hasattr(tif.TiffWriter, 'write'):
+        return {'compress': compress}
+    if 'compressionargs' in inspect.signature(tif.TiffWriter.write).parameters:
+        return {'compression': 'zlib', 'compressionargs': {'level': compress}}
+
+    return {'compression': ('zlib', compress)}
+
+def write_tiff(fname, image, compress=0):
+
+    ''' Save an image as TIFF, deflate-compressed at level compress (0 = uncompressed)'''
+
+    # imsave was renamed imwrite and then removed from tifffile
+    imwrite = getattr(tif, 'imwrite', None) or tif.imsave
+    imwrite(fname, image, **_tiff_compression(compress))
+
+class _ThreadedWriter(object):
+
+    # Pool of threads running the writes, with at most max_in_flight of them pending.
+    # Errors of the threads are raised by _submit, flush or close
+
+    def __init__(self, workers=1, max_in_flight=None):
+
+        self.workers = workers
+        self.max_in_flight = max_in_flight or 2*self.workers
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+
+    def _submit(self, func, *args):
+
+        self.pending.append(self.pool.submit(func, *args))
+        while len(self.pending) >= self.max_in_flight:
+            self.pending.popleft().result()
+
+    def flush(self):
+
+        ''' Wait for all the queued images to be written'''
+
+        while self.pending:
+            self.pending.popleft().result()
+
+    def _finish(self):
+        # Run once all the images are written (e.g. to close a file)
+        pass
+
+    def close(self):
+
+        ''' Flush, shut down the threads and close the output'''
+
+        try:
+            self.flush()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.pool.shutdown()
+            self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original error
+            try:
+                self.close()
+            except Exception:
+                pass
+
+class ProjectionWriter(_ThreadedWriter):
+
+    ''' Encodes and writes image files on a pool of threads, so that writing a file 
+    overlaps with preparing the next ones. At most max_in_flight images (default 
+    2*workers) are waiting to be written, write blocks beyond that. Errors of the 
+    threads are raised by write, flush or close'''
+
+    def __init__(self, workers=None, compress=0, max_in_flight=None):
+
+        _ThreadedWriter.__init__(self, workers or IO_WORKERS, max_in_flight)
+        self.compress = compress
+
+    def write(self, fname, image):
+
+        ''' Queue image to be saved as fname. image must not be modified afterwards'''
+
+        self._submit(write_tiff, fname, image, self.compress)
+
+class TiffSeriesWriter(ProjectionWriter):
+
+    ''' Volume output as one TIFF file per projection, named base+NNNN.tif'''
+
+    def __init__(self, base, workers=None, compress=0):
+
+        ProjectionWriter.__init__(self, workers, compress)
+        self.base = base
+
+    def write_projection(self, k, image):
+
+        ''' Queue projection k. image must not be modified afterwards'''
+
+        self.write(self.base+str(k).zfill(4)+'.tif', image)
+
+def _write_page(tf, image, compress=0, **kwargs):
+
+    # Append a page to an open TiffWriter, for old (save) and new (write) versions of tifffile
+    kwargs.update(_tiff_compression(compress))
+    if hasattr(tf, 'write'):
+        tf.write(image, **kwargs)
+    else:
+        tf.save(image, **kwargs)
+
+class BigTiffWriter(_ThreadedWriter):
+
+    ''' Volume output as a single multi-page BigTIFF file of shape (angles, rows, pixels),
+    one page per projection written in order, read back as a single series (e.g. by
+    tifffile.imread). The metadata dictionary is stored as JSON in the description 
+    of the first page. The pages are encoded on a separate thread'''
+
+    def __init__(self, fname, shape, dtype, compress=0, metadata=None):
+
+        _ThreadedWriter.__init__(self, 1)
+        self.compress = compress
+        self.metadata = metadata or {}
+        self.next = 0
+        self.tf = tif.TiffWriter(fname, bigtiff=True)
+
+        # Compressed pages cannot be appended to a series one at a time: with the current
+        # versions of tifffile a single write call takes all the projections from a queue
+        self.pages = self.writing = None
+        if hasattr(self.tf, 'write'):
+            self.pages = queue.Queue(self.max_in_flight)
+            self.writing = self.pool.submit(self.tf.write, self._iter_pages(), shape=tuple(shape), \
+                                            dtype=dtype, photometric='minisblack', metadata=None, \
+                                            description=json.dumps(self.metadata), **_tiff_compression(compress))
+
+    def _write(self, k, image):
+
+        # Older versions of tifffile: pages appended to the series of the first one
+        kwargs = {'description': json.dumps(self.metadata)} if k == 0 else {}
+        _write_page(self.tf, image, self.compress, contiguous=True, **kwargs)
+
+    def _iter_pages(self):
+
+        # Projections of the queue, up to the None closing it
+        while True:
+            image = self.pages.get()
+            if image is None:
+                return
+            yield image
+
+    def _put(self, item):
+
+        # Queue an item for the write call, raising its error if it has stopped
+        while True:
+            try:
+                self.pages.put(item, timeout=0.05)
+                return
+            except queue.Full:
+                if self.writing.done():
+                    self.writing.result()
+                    raise ValueError("More projections than the shape of the volume")
+
+    def write_projection(self, k, image):
+
+        ''' Queue projection k. The projections must come in order'''
+
+        if k != self.next:
+            raise ValueError("Projection %d written after projection %d" % (k, self.next-1))
+        self.next += 1
+        if self.pages is not None:
+            self._put(np.asarray(image))
+        else:
+            self._submit(self._write, k, image)
+
+    def close(self):
+
+        ''' Wait for the projections to be written and close the file'''
+
+        try:
+            if self.pages is not None and not self.writing.done():
+                self._put(None)
+        finally:
+            _ThreadedWriter.close(self)
+
+        if self.writing is not None:
+            self.writing.result()
+
+    def _finish(self):
+        self.tf.close()
+
+class HDF5Writer(_ThreadedWriter):
+
+    ''' Volume output as a chunked HDF5 dataset (angles, rows, pixels) named 
+    projections, compressed with gzip at level compress (0 = uncompressed). 
+    Each chunk holds at most chunk_rows rows of one projection, so that both
+    projections and ranges of slices can be read back partially. 
+    The metadata dictionary is stored in the attributes of the dataset'''
+
+    def __init__(self, fname, shape, dtype, compress=0, metadata=None, chunk_rows=64):
+
+        if H5PY is False:
+            raise ImportError("The HDF5 output requires h5py")
+
+        _ThreadedWriter.__init__(self, 1)
+        self.f = h5py.File(fname, 'w')
+        kwargs = {'compression': 'gzip', 'compression_opts': compress} if compress else {}
+        self.dset = self.f.create_dataset('projections', shape=tuple(shape), dtype=dtype, \
+                                          chunks=(1, min(chunk_rows, shape[1]), shape[2]), **kwargs)
+        for key, value in (metadata or {}).items():
+            self.dset.attrs[key] = value
+
+    def _write(self, k, image):
+        self.dset[k] = image
+
+    def write_projection(self, k, image):
+
+        ''' Queue projection k. image must not be modified afterwards'''
+
+        self._submit(self._write, k, image)
+
+    def _finish(self):
+        self.f.close()
+
+# Output formats of the processed volume
+VOLUME_FORMATS = ('tiff', 'bigtiff', 'hdf5')
+
+def volume_writer(fmt, base, shape, dtype, compress=0, metadata=None, workers=None):
+
+    ''' Writer of a volume of projections of shape (angles, rows, pixels) in the format
+    fmt (one of VOLUME_FORMATS): base+NNNN.tif for each projection, base.tif or base.h5. 
+    All the writers have write_projection(k, image) and close()'''
+
+    if fmt == 'tiff':
+        return TiffSeriesWriter(base, workers, compress)
+    if fmt == 'bigtiff':
+        return BigTiffWriter(base+'.tif', shape, dtype, compress, metadata)
+    if fmt == 'hdf5':
+        return HDF5Writer(base+'.h5', shape, dtype, compress, metadata)
+
+    raise ValueError("Unknown output format "+str(fmt))
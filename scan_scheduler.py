@@ -0,0 +1,278 @@
+''' This file contains the scheduler running the batch processing of many scans,
+    several at a time within a budget of cores and memory. It can be used as a
+    module or from the command line with a JSON list of scans:
+
+    python scan_scheduler.py scans.json --cpus 32 --memory 64
+
+    where each scan is {"directory": ..., "low": ..., "hi": ..., "sigma": ..., ...}
+    with the options of DeconvolutionBatch'''
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+# psutil is only used for the default memory budget
+try:
+    import psutil
+    PSUTIL = True
+except ImportError:
+    PSUTIL = False
+
+from batch_utilities import SlabPool
+from deconvolution_batch import load_scan, DeconvolutionBatch
+
+
+def memory_estimate(scan, nblock=16, processes=1):
+
+    ''' Memory (bytes) used by the batch of a scan: the slabs read ahead, in the pool
+    and waiting to be stored, plus the FFT workspace of each process. The intermediate
+    volume is a memory map on disk and is not counted'''
+
+    slab = 4*nblock*scan.shape[1]*scan.nangles
+
+    return slab*(processes+5) + 3*slab*processes
+
+class ScanJob(object):
+
+    ''' A scan to process: its directory, the slices [low, hi) (hi=None for all), the
+    output directory (default <directory>/deconvolution) and the options of
+    DeconvolutionBatch. The scheduler updates status ('queued', 'running', 'done'
+    or 'failed'), message, fraction and error. The backend must be 'cpu' or 'auto' 
+    (run as 'cpu'), a ValueError is raised otherwise'''
+
+    def __init__(self, directory, low=0, hi=None, out_dir=None, **options):
+
+        if options.get('backend', 'cpu') not in ('cpu', 'auto'):
+            # The batches run on threads of the scheduler, the GPU context belongs to the main thread
+            raise ValueError("The scheduler runs the CPU backend only")
+
+        self.directory = directory
+        self.low, self.hi = low, hi
+        self.out_dir = out_dir or os.path.join(directory, 'deconvolution')
+        self.options = options
+        self.options['backend'] = 'cpu'
+
+        self.scan = None
+        self.status = 'queued'
+        self.message = ''
+        self.fraction = 0.0
+        self.error = None
+        self.start = self.end = None
+
+    @property
+    def nslices(self):
+        return 0 if self.hi is None else self.hi-self.low
+
+    @property
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    @property
+    def throughput(self):
+
+        ''' Slices processed per second'''
+
+        if self.status != 'done' or self.elapsed == 0:
+            return 0.0
+        return self.nslices/self.elapsed
+
+class ScanScheduler(object):
+
+    ''' Runs queued ScanJobs, several at a time. A job takes processes cores (its SlabPool)
+    and the memory given by memory_estimate, and starts in order of submission once it
+    fits in the budget of cpus cores (default all) and memory bytes (default 80% of the
+    available memory with psutil, unlimited otherwise). A job larger than the budget
+    runs alone. on_status(job) is called at each change of status or progress'''
+
+    def __init__(self, cpus=None, memory=None, processes=4, on_status=None):
+
+        self.cpus = cpus or os.cpu_count() or 1
+        if memory is None and PSUTIL:
+            memory = 0.8*psutil.virtual_memory().available
+        self.memory = memory
+        self.processes = max(min(processes, self.cpus), 1)
+        self.on_status = on_status
+
+        self.jobs = []
+        self.queue = []
+        self.running = {}
+        self.cond = threading.Condition()
+
+    def submit(self, job):
+
+        ''' Add a job to the queue'''
+
+        with self.cond:
+            self.jobs.append(job)
+            self.queue.append(job)
+            self.cond.notify_all()
+        self._report(job)
+
+        return job
+
+    def reject(self, job, error):
+
+        ''' Add a job that cannot run (e.g. with invalid options) as failed with error'''
+
+        with self.cond:
+            self.jobs.append(job)
+        self._finish(job, error)
+
+        return job
+
+    def _report(self, job):
+        if self.on_status is not None:
+            self.on_status(job)
+
+    def _fits(self, cost):
+
+        # True if a job with cost (cores, bytes) can start now
+        if not self.running:
+            return True
+        cpus = sum(c[0] for c in self.running.values()) + cost[0]
+        memory = sum(c[1] for c in self.running.values()) + cost[1]
+
+        return cpus <= self.cpus and (self.memory is None or memory <= self.memory)
+
+    def run(self):
+
+        ''' Run all the queued jobs and wait for them. Returns the list of jobs'''
+
+        threads = []
+        while True:
+            with self.cond:
+                if not self.queue:
+                    break
+                job = self.queue[0]
+
+            # Read the scan to know the size of the job
+            if job.scan is None:
+                try:
+                    job.scan = load_scan(job.directory)
+                    if job.hi is None:
+                        job.hi = job.scan.shape[0]
+                except Exception as e:
+                    with self.cond:
+                        self.queue.pop(0)
+                    self._finish(job, e)
+                    continue
+
+            cost = (self.processes, memory_estimate(job.scan, job.options.get('nblock', 16), self.processes))
+
+            with self.cond:
+                while not self._fits(cost):
+                    self.cond.wait()
+                self.queue.pop(0)
+                self.running[job] = cost
+
+            thread = threading.Thread(target=self._run_job, args=(job,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return self.jobs
+
+    def _run_job(self, job):
+
+        job.status = 'running'
+        job.start = time.time()
+        self._report(job)
+
+        def progress(message, fraction):
+            job.message = message
+            if fraction is not None:
+                job.fraction = fraction
+            self._report(job)
+
+        error = None
+        pool = SlabPool(self.processes)
+        try:
+            DeconvolutionBatch(job.scan, job.out_dir, job.low, job.hi, pool=pool, \
+                               **job.options).run(progress=progress)
+        except Exception as e:
+            error = e
+        finally:
+            pool.close()
+            with self.cond:
+                self.running.pop(job, None)
+                self.cond.notify_all()
+
+        self._finish(job, error)
+
+    def _finish(self, job, error=None):
+
+        job.end = time.time()
+        job.error = error
+        job.status = 'failed' if error is not None else 'done'
+        job.message = str(error) if error is not None else ''
+        self._report(job)
+
+    def report(self):
+
+        ''' Summary of the status and throughput of the jobs, one line per job'''
+
+        lines = []
+        for job in self.jobs:
+            line = "%-8s %s [%d, %d) %.0f s" % (job.status, job.directory, job.low, job.hi or 0, job.elapsed)
+            if job.status == 'done':
+                line += ", %.2f slices/s" % job.throughput
+            if job.status == 'failed':
+                line += ": "+job.message
+            lines.append(line)
+
+        done = [job for job in self.jobs if job.status == 'done']
+        if done:
+            wall = max(job.end for job in done) - min(job.start for job in done)
+            if wall > 0:
+                lines.append("Total: %d slices in %.0f s, %.2f slices/s" % \
+                             (sum(job.nslices for job in done), wall, sum(job.nslices for job in done)/wall))
+
+        return '\n'.join(lines)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Batch processing of a list of OPT scans")
+    parser.add_argument('scans', help="JSON file with the list of scans and their options")
+    parser.add_argument('--cpus', type=int, default=None, help="cores used by all the scans (default all)")
+    parser.add_argument('--memory', type=float, default=None, help="memory used by all the scans, in GB")
+    parser.add_argument('--processes', type=int, default=4, help="processes of each scan")
+    args = parser.parse_args(argv)
+
+    with open(args.scans) as f:
+        scans = json.load(f)
+
+    lock = threading.Lock()
+    shown = {}
+    def on_status(job):
+        # Print the changes of status and every 10% of progress
+        state = (job.status, job.message, int(10*job.fraction))
+        with lock:
+            if shown.get(job) != state:
+                shown[job] = state
+                print(job.directory+": "+job.status+" "+job.message+ \
+                      (" "+str(int(100*job.fraction))+"%" if job.status == 'running' else ''))
+                sys.stdout.flush()
+
+    memory = None if args.memory is None else args.memory*1024**3
+    scheduler = ScanScheduler(cpus=args.cpus, memory=memory, processes=args.processes, on_status=on_status)
+    for options in scans:
+        try:
+            scheduler.submit(ScanJob(**options))
+        except (TypeError, ValueError) as e:
+            # Invalid options fail this scan only, the others still run
+            directory = str(options.get('directory', '')) if isinstance(options, dict) else str(options)
+            scheduler.reject(ScanJob(directory), e)
+    scheduler.run()
+
+    print(scheduler.report())
+
+if __name__ == '__main__':
+    main()
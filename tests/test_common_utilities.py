@@ -0,0 +1,26 @@
+''' Rotation centre estimated from the sinograms'''
+
+import numpy as np
+import pytest
+from skimage.data import shepp_logan_phantom
+from skimage.transform import radon, resize
+
+from common_utilities import sino_center, sino_centering
+
+def centred_sinogram(nx):
+
+    # Sinogram (pixels, angles) of a phantom over 360 deg, with the rotation axis at nx//2
+    # as in skimage.transform.iradon
+    image = resize(shepp_logan_phantom(), (nx, nx))
+    return radon(image, np.linspace(0, 360, 180, endpoint=False))
+
+@pytest.mark.parametrize('nx', [128, 129])
+@pytest.mark.parametrize('shift', [0, 1, 3, -4, 7])
+def test_sino_center(nx, shift):
+
+    sinogram = np.roll(centred_sinogram(nx), shift, axis=0)
+    center, confidence = sino_center(sinogram)
+
+    assert abs(center + shift) < 0.05
+    assert confidence > 0.99
+    assert sino_centering(sinogram) == -shift
@@ -0,0 +1,56 @@
+''' The fast (single precision, real-input FFT) paths of the CPU deconvolution
+    against the original complex128 computation'''
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from deconvolution_CPUutilities import runDeconvolutionCPU, runDeconvolutionCPUBatch, estimateFilterCPU
+
+PIXEL_SIZE = 6.5
+
+def sinograms(shape, nslices=3, seed=0):
+
+    # Smooth positive sinograms (slices, pixels, angles) with some noise
+    rng = np.random.default_rng(seed)
+    data = gaussian_filter(rng.random((nslices,)+shape), (0, 3, 1)) + 0.01*rng.random((nslices,)+shape)
+
+    return 1000*data
+
+def reference(sinogram, transfer=None):
+    # The input is modified by runDeconvolutionCPU
+    return runDeconvolutionCPU(np.array(sinogram, dtype='float64'), PIXEL_SIZE, transfer=transfer, fast=False)
+
+def assert_close(result, expected):
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-5*np.max(np.abs(expected)))
+
+@pytest.mark.parametrize('shape', [(128, 90), (127, 91)])
+def test_fast(shape):
+
+    for sinogram in sinograms(shape):
+        result = runDeconvolutionCPU(np.array(sinogram), PIXEL_SIZE, fast=True)
+        assert result.dtype == np.float32
+        assert_close(result, reference(sinogram))
+
+@pytest.mark.parametrize('shape', [(128, 90), (127, 91)])
+def test_batch(shape):
+
+    stack = sinograms(shape)
+    result = runDeconvolutionCPUBatch(stack, PIXEL_SIZE)
+
+    assert result.shape == stack.shape
+    for k in range(len(stack)):
+        assert_close(result[k], reference(stack[k]))
+
+@pytest.mark.parametrize('shape', [(128, 90), (127, 91)])
+def test_scan_filter(shape):
+
+    stack = sinograms(shape)
+    fast = estimateFilterCPU(list(stack), PIXEL_SIZE, fast=True)
+    slow = estimateFilterCPU(list(stack), PIXEL_SIZE, fast=False)
+
+    batch = runDeconvolutionCPUBatch(stack, PIXEL_SIZE, transfer=fast)
+    for k in range(len(stack)):
+        expected = reference(stack[k], transfer=slow)
+        assert_close(runDeconvolutionCPU(np.array(stack[k]), PIXEL_SIZE, transfer=fast), expected)
+        assert_close(batch[k], expected)
@@ -0,0 +1,33 @@
+''' Numpy filtered back-projection against skimage.transform.iradon'''
+
+import numpy as np
+import pytest
+from skimage.data import shepp_logan_phantom
+from skimage.transform import radon, iradon, resize
+
+from fbp_CPUutilities import iradon_cpu
+
+THETA = np.linspace(0, 180, 90, endpoint=False)
+
+def sinogram(nx):
+
+    # Sinogram (pixels, angles) of a phantom, zero at the edges of the detector
+    return radon(resize(shepp_logan_phantom(), (nx, nx)), THETA)
+
+@pytest.mark.parametrize('nx', [128, 129])
+@pytest.mark.parametrize('shift', [0, 2, -3])
+def test_iradon_cpu(nx, shift):
+
+    sino = sinogram(nx)
+    expected = iradon(np.roll(sino, shift, axis=0), THETA, nx)
+    result = iradon_cpu(sino, THETA, nx, shift=shift)
+
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-4*np.max(np.abs(expected)))
+
+def test_iradon_cpu_circle():
+
+    result = iradon_cpu(sinogram(128), THETA, 128)
+    coords = np.arange(128) - 64
+
+    assert np.all(result[coords[:,np.newaxis]**2 + coords[np.newaxis,:]**2 > 64**2] == 0)
@@ -0,0 +1,65 @@
+''' Reading rows of the projections straight from the bytes of the TIFF files,
+    against the decoded images'''
+
+import numpy as np
+import pytest
+import tifffile
+
+from io_utilities import tiff_layout, read_rows, read_row, read_row_list
+
+SHAPE = (20, 12)
+
+# Layouts of the projection files: uncompressed (little and big endian, one or
+# several strips) and compressed
+LAYOUTS = {'plain': {},
+           'big_endian': {'byteorder': '>'},
+           'strips': {'rowsperstrip': 3},
+           'big_endian_strips': {'byteorder': '>', 'rowsperstrip': 7},
+           'compressed': {'compression': 'zlib'}}
+
+@pytest.fixture(params=sorted(LAYOUTS))
+def projection(request, tmp_path):
+
+    image = np.arange(np.prod(SHAPE), dtype='uint16').reshape(SHAPE)*7
+    fname = str(tmp_path / (request.param+'.tif'))
+    tifffile.imwrite(fname, image, **LAYOUTS[request.param])
+
+    return request.param, fname, image
+
+def test_tiff_layout(projection):
+
+    name, fname, image = projection
+    layout = tiff_layout(fname)
+
+    if name == 'compressed':
+        assert layout is None
+    else:
+        offset, dtype, shape = layout
+        assert shape == SHAPE
+        assert dtype == np.dtype(LAYOUTS[name].get('byteorder', '<')+'u2')
+
+def test_read_rows(projection):
+
+    _, fname, image = projection
+
+    np.testing.assert_array_equal(read_rows(fname, 3, 9), image[3:9])
+    np.testing.assert_array_equal(read_rows(fname, -5, -1), image[-5:-1])
+    np.testing.assert_array_equal(read_rows(fname, 15, 40), image[15:40])
+    assert read_rows(fname, 9, 3).shape == (0, SHAPE[1])
+
+@pytest.mark.parametrize('k', [0, 7, SHAPE[0]-1, -1, -8, SHAPE[0], 3*SHAPE[0]+5])
+def test_read_row(projection, k):
+
+    _, fname, image = projection
+
+    np.testing.assert_array_equal(read_row(fname, k), image[k % SHAPE[0]])
+
+def test_read_row_list(projection):
+
+    _, fname, image = projection
+    rows = [5, 6, 7, 2, -1, 19, 0, 25, 6, -20, 11]
+
+    result = read_row_list(fname, rows)
+
+    assert result.dtype.newbyteorder('=') == image.dtype
+    np.testing.assert_array_equal(result, image[np.asarray(rows) % SHAPE[0]])